@@ -0,0 +1,479 @@
+# benchmark.py
+#
+# Offline benchmark and load simulation for Meep's playback pipeline.
+#
+# Drives the real Music cog with fake Discord objects, a stubbed resolver in
+# place of yt-dlp and local audio fixtures, so no Discord token or network
+# access is needed. Results are printed as JSON for comparison between releases.
+#
+#   python benchmark.py --guilds 200 --duration 60 --output bench.json
+#   python benchmark.py --compare bench.json   # exits 1 on regressions
+#
+# It also exits 1 if any track ends without playing a single frame.
+
+import os
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")  # musicbot refuses to import without one
+os.environ.setdefault("RESOLVER_MODE", "thread")  # the stubbed resolver must run in-process
+os.environ.setdefault("STATE_DB", "")  # don't persist or restore simulated queues
+os.environ.setdefault("SESSION_LIMIT", "0")  # measure every simulated guild playing at once
+
+import discord
+import musicbot
+
+FRAME_LENGTH = 0.02  # seconds of audio per frame, as in discord.py's player
+PCM_FRAME = b"\0" * 3840
+
+# Regressions are only checked for "lower is better" metrics
+COMPARED_METRICS = [
+    ("commands", "play", "p95_ms"),
+    ("commands", "skip", "p95_ms"),
+    ("commands", "queue", "p95_ms"),
+    ("commands", "volume", "p95_ms"),
+    ("loop_lag_ms", "p99_ms"),
+    ("transition_gap_ms", "p95_ms"),
+    ("cpu_per_stream_pct",),
+    ("memory_per_guild_kb",),
+]
+
+
+def percentiles(samples: list) -> dict:
+    """Summarize samples (in seconds) as millisecond percentiles"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)] * 1000, 3)
+    return {"count": len(ordered), "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99),
+            "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def rss_kb() -> int:
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# ─── Fixtures ──────────────────────────────────────────────────────────────────
+# (acodec as yt-dlp reports it, FFmpeg encoder, file extension). YouTube serves
+# both, and they take different paths: Opus can be stream-copied, AAC is re-encoded
+FIXTURE_FORMATS = [("opus", "libopus", "opus"), ("aac", "aac", "m4a")]
+
+
+def make_fixtures(ffmpeg: str, directory: str, count: int, seconds: float) -> list:
+    """Render short test tones, alternating Opus and AAC, as (path, acodec) pairs"""
+    fixtures = []
+    for i in range(count):
+        acodec, encoder, extension = FIXTURE_FORMATS[i % len(FIXTURE_FORMATS)]
+        path = os.path.join(directory, f"fixture-{i}.{extension}")
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi",
+             "-i", f"sine=frequency={220 + 40 * i}:duration={seconds}",
+             "-ac", "2", "-ar", "48000", "-c:a", encoder, "-b:a", "96k", path],
+            check=True,
+        )
+        fixtures.append((path, acodec))
+    return fixtures
+
+
+class SilenceSource(discord.AudioSource):
+    """Stand-in for FFmpeg when no binary is available: silent PCM frames"""
+
+    def __init__(self, seconds: float, volume: float = 1.0):
+        self.frames = int(seconds / FRAME_LENGTH)
+        self.volume = volume
+
+    def read(self) -> bytes:
+        if self.frames <= 0:
+            return b""
+        self.frames -= 1
+        return PCM_FRAME
+
+
+# ─── Fake Discord objects ─────────────────────────────────────────────────────
+class Stats:
+    def __init__(self):
+        self.commands: dict[str, list] = {}
+        self.loop_lag: list = []
+        self.gaps: list = []
+        self.frames = 0
+        self.tracks_started = 0
+        self.silent_tracks = 0
+        self.stream_seconds = 0.0
+        self.lock = threading.Lock()
+
+
+class FakeVoiceClient:
+    """Plays sources the way discord.py's AudioPlayer does: one thread per
+    connection reading a frame every 20 ms, calling after() on the audio thread"""
+
+    def __init__(self, channel, guild, stats: Stats):
+        self.channel = channel
+        self.guild = guild
+        self.stats = stats
+        self.source = None
+        self._connected = True
+        self._playing = False
+        self._paused = threading.Event()
+        self._stop = threading.Event()
+        self._ended_at = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._playing and self._paused.is_set()
+
+    def play(self, source, *, after=None):
+        if self._playing:
+            raise discord.ClientException("Already playing audio.")
+        self.source = source
+        self._playing = True
+        self._stop.clear()
+        self._paused.clear()
+        threading.Thread(target=self._run, args=(source, after), daemon=True).start()
+
+    def _run(self, source, after):
+        started = next_frame = time.perf_counter()
+        first = True
+        frames = source_frames = 0
+        while not self._stop.is_set():
+            if self._paused.is_set():
+                time.sleep(FRAME_LENGTH)
+                next_frame = time.perf_counter()
+                continue
+            if self.source is not source:
+                # Swapped mid-track (.volume in Opus mode); the new source has to play too
+                source, source_frames = self.source, 0
+            data = source.read()
+            if first:
+                first = False
+                with self.stats.lock:
+                    self.stats.tracks_started += 1
+                    if self._ended_at is not None:
+                        self.stats.gaps.append(time.perf_counter() - self._ended_at)
+            if not data:
+                break
+            frames += 1
+            source_frames += 1
+            next_frame += FRAME_LENGTH
+            time.sleep(max(0.0, next_frame - time.perf_counter()))
+        try:
+            self.source.cleanup()
+        except Exception:
+            pass
+        with self.stats.lock:
+            self.stats.frames += frames
+            if not source_frames and not self._stop.is_set():
+                self.stats.silent_tracks += 1  # ended without a frame, e.g. FFmpeg rejected its input
+            self.stats.stream_seconds += time.perf_counter() - started
+        self._ended_at = time.perf_counter()
+        self._playing = False
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self._connected = False
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, stats: Stats):
+        self.guild = guild
+        self.name = f"voice-{guild.id}"
+        self.stats = stats
+
+    async def connect(self, *, timeout=60.0, reconnect=True, **kwargs):
+        vc = FakeVoiceClient(self, self.guild, self.stats)
+        self.guild.voice_client = vc
+        return vc
+
+
+class FakeTextChannel:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"text-{guild_id}"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        return self
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.voice_client = None
+
+
+class FakeAuthor:
+    def __init__(self, channel):
+        self.voice = type("VoiceState", (), {"channel": channel})()
+        self.id = channel.guild.id
+        self.guild_permissions = discord.Permissions.all()
+
+
+class FakeContext:
+    def __init__(self, guild: FakeGuild, stats: Stats):
+        self.guild = guild
+        self.channel = FakeTextChannel(guild.id)
+        self.author = FakeAuthor(FakeVoiceChannel(guild, stats))
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeBot:
+    """Just enough of commands.Bot for the Music cog"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.latency = 0.0
+        self.presence_updates = 0
+        self.guilds = []
+        self.voice_clients = []
+        self.worker_id = None
+
+    async def change_presence(self, **kwargs):
+        self.presence_updates += 1
+
+    async def wait_until_ready(self):
+        pass
+
+    def is_ready(self):
+        return False
+
+    def get_channel(self, channel_id):
+        return None
+
+
+# ─── Simulation ────────────────────────────────────────────────────────────────
+def install_stub_resolver(fixtures: list, fixture_seconds: float, latency: float):
+    """Replace the yt-dlp worker with one that returns local fixtures"""
+    def resolve(query: str):
+        time.sleep(latency)  # simulated network round-trip
+        digest = hashlib.sha1(query.encode()).hexdigest()
+        video_id = digest[:11]
+        url, acodec = fixtures[int(digest, 16) % len(fixtures)] if fixtures else (f"synthetic:{video_id}", "opus")
+        return {"id": video_id, "title": f"Track {video_id}", "url": url,
+                "expires": time.time() + 6 * 3600, "duration": fixture_seconds,
+                "acodec": acodec, "abr": 96}
+    musicbot._resolve_in_worker = resolve
+
+
+async def invoke(stats: Stats, name: str, command, cog, ctx, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        await command.callback(cog, ctx, *args, **kwargs)
+    finally:
+        stats.commands.setdefault(name, []).append(time.perf_counter() - started)
+
+
+async def guild_session(cog, ctx, stats: Stats, args, song_pool: list, deadline: float):
+    rng = random.Random(ctx.guild.id)
+    for _ in range(args.tracks):
+        await invoke(stats, "play", cog.play, cog, ctx, query=rng.choice(song_pool))
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.uniform(0.5, 3.0))
+        action = rng.random()
+        if action < 0.4:
+            await invoke(stats, "queue", cog.queue, cog, ctx)
+        elif action < 0.7:
+            await invoke(stats, "play", cog.play, cog, ctx, query=rng.choice(song_pool))
+        elif action < 0.85:
+            # Anything but 100% makes FFmpeg re-encode in Opus mode
+            await invoke(stats, "volume", cog.volume, cog, ctx, rng.choice([50, 80, 100]))
+        else:
+            await invoke(stats, "skip", cog.skip, cog, ctx)
+
+
+async def loop_watchdog(stats: Stats, interval: float = 0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def simulate(args, fixtures: list) -> dict:
+    stats = Stats()
+    bot = FakeBot()
+    install_stub_resolver(fixtures, args.fixture_seconds, args.resolve_latency)
+    if not fixtures:
+        musicbot.Music.make_source = lambda self, track, volume=1.0, start=0.0: SilenceSource(
+            args.fixture_seconds - start, volume)
+
+    rss_before = rss_kb()
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    cog = musicbot.Music(bot)
+    cog.version_check_task.cancel()  # no GitHub calls while benchmarking
+    watchdog = asyncio.ensure_future(loop_watchdog(stats))
+    song_pool = [f"benchmark song {i}" for i in range(args.songs)]
+    contexts = [FakeContext(FakeGuild(guild_id), stats) for guild_id in range(1, args.guilds + 1)]
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    sessions = []
+    for ctx in contexts:
+        sessions.append(asyncio.ensure_future(guild_session(cog, ctx, stats, args, song_pool, deadline)))
+        await asyncio.sleep(args.ramp / max(args.guilds, 1))
+    await asyncio.gather(*sessions)
+    rss_peak = rss_kb()
+    elapsed = time.perf_counter() - started
+
+    for ctx in contexts:
+        if ctx.voice_client is not None:
+            await ctx.voice_client.disconnect()
+    await asyncio.sleep(0.2)
+    watchdog.cancel()
+    await cog.cog_unload()
+
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = (cpu_after.ru_utime - cpu_before.ru_utime + cpu_after.ru_stime - cpu_before.ru_stime
+                   + children.ru_utime + children.ru_stime)
+    return {
+        "config": {
+            "guilds": args.guilds, "duration_s": args.duration, "tracks_per_guild": args.tracks,
+            "songs": args.songs, "resolve_latency_s": args.resolve_latency,
+            "fixture_seconds": args.fixture_seconds, "source": "ffmpeg" if fixtures else "synthetic",
+            "playback_mode": musicbot.PLAYBACK_MODE, "python": sys.version.split()[0],
+            "discord_py": discord.__version__, "bot_version": musicbot.CURRENT_VERSION,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "commands": {name: percentiles(samples) for name, samples in sorted(stats.commands.items())},
+        "loop_lag_ms": percentiles(stats.loop_lag),
+        "transition_gap_ms": percentiles(stats.gaps),
+        "tracks_started": stats.tracks_started,
+        "silent_tracks": stats.silent_tracks,
+        "frames_played": stats.frames,
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_per_stream_pct": round(100 * cpu_seconds / stats.stream_seconds, 3) if stats.stream_seconds else None,
+        "memory_per_guild_kb": round((rss_peak - rss_before) / max(args.guilds, 1), 2),
+        "presence": {"requests": cog.presence.requests, "updates": bot.presence_updates},
+        "audio_buffer": {"underruns": musicbot.ReadAheadSource.total_underruns},
+        "messages": {"queued": cog.outbox.queued, "sent": cog.outbox.sent, "edits": cog.outbox.edits},
+        "resolver": {"cache": cog.resolver.cache.stats(), "coalesced": cog.resolver.coalesced},
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """List metrics that got worse than the baseline by more than tolerance"""
+    regressions = []
+    for path in COMPARED_METRICS:
+        new, old = result, baseline
+        for key in path:
+            new = new.get(key) if isinstance(new, dict) else None
+            old = old.get(key) if isinstance(old, dict) else None
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)) and old > 0:
+            if new > old * (1 + tolerance):
+                regressions.append({"metric": ".".join(path), "baseline": old, "current": new,
+                                    "change_pct": round(100 * (new - old) / old, 1)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load benchmark for Meep's playback pipeline")
+    parser.add_argument("--guilds", type=int, default=100, help="simulated guilds")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of simulated activity")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks each guild queues up front")
+    parser.add_argument("--songs", type=int, default=50, help="distinct songs shared by all guilds")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which guilds join")
+    parser.add_argument("--resolve-latency", type=float, default=0.05, help="simulated lookup time in seconds")
+    parser.add_argument("--fixture-seconds", type=float, default=4, help="length of each test track")
+    parser.add_argument("--ffmpeg", default=None, help="FFmpeg binary (default: FFMPEG_EXECUTABLE or PATH)")
+    parser.add_argument("--synthetic", action="store_true", help="skip FFmpeg and play silent frames (codec paths untested)")
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline (0.2 = 20%%)")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log output")
+    args = parser.parse_args()
+    if not args.verbose:
+        musicbot.logger.setLevel(logging.WARNING)
+        logging.getLogger("discord").setLevel(logging.WARNING)
+
+    ffmpeg = None
+    if not args.synthetic:
+        ffmpeg = args.ffmpeg or (musicbot.FFMPEG_EXECUTABLE if os.path.exists(musicbot.FFMPEG_EXECUTABLE)
+                                 else shutil.which("ffmpeg"))
+        if ffmpeg is None:
+            musicbot.logger.warning("FFmpeg not found; using synthetic audio frames")
+
+    with tempfile.TemporaryDirectory(prefix="meep-bench-") as fixture_dir:
+        fixtures = []
+        if ffmpeg:
+            musicbot.FFMPEG_EXECUTABLE = ffmpeg
+            # Fixtures are local files, so the HTTP reconnect flags don't apply
+            musicbot.FFMPEG_OPTIONS["before_options"] = ""
+            fixtures = make_fixtures(ffmpeg, fixture_dir, 4, args.fixture_seconds)
+        result = asyncio.run(simulate(args, fixtures))
+
+    exit_code = 0
+    if result["silent_tracks"]:
+        # Every track must produce audio; silence means a source or codec path is broken
+        musicbot.logger.error(f"{result['silent_tracks']} track(s) ended without playing a frame")
+        exit_code = 1
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        result["regressions"] = compare(result, baseline, args.tolerance)
+        if result["regressions"]:
+            exit_code = 1
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
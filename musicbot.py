@@ -1,60 +1,2335 @@
 # discord_music_bot.py
 
+import time
+STARTUP_BEGAN = time.perf_counter()  # taken before the imports below, for the startup report
+
 import os
 import asyncio
+import atexit
+import concurrent.futures
+import ctypes.util
+import difflib
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+import random
+import signal
+import sys
 import re
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import parse_qs, urlparse
 import aiohttp
+from aiohttp import web
 import discord
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
-from yt_dlp import YoutubeDL, DownloadError
 from discord import PCMVolumeTransformer
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('musicbot.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+# yt-dlp and numpy are imported on first use (see load_ytdl/load_numpy) to keep startup fast
+if TYPE_CHECKING:
+    from yt_dlp import YoutubeDL
+np = None
+
+# ─── Logging ────────────────────────────────────────────────────────────────────
+load_dotenv()  # before anything reads the environment, logging included
+
+LOG_FILE = os.getenv("LOG_FILE", "musicbot.log")  # empty logs to the console only
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json" (one object per line)
+LOG_MAX_MB = int(os.getenv("LOG_MAX_MB", "50"))  # rotate once the file reaches this size
+LOG_ROTATE_HOURS = int(os.getenv("LOG_ROTATE_HOURS", "24"))  # ...or this age (0 = size only)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))  # rotated files kept
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread before new ones are dropped
+LOG_SAMPLE_BURST = 20  # debug lines let through per call site...
+LOG_SAMPLE_INTERVAL = 60  # ...per this many seconds; the rest are counted and summarised
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single-line JSON object"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    """Rotates the log file once it passes max_bytes or is older than interval seconds"""
+
+    def __init__(self, filename: str, max_bytes: int, backups: int, interval: float):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.interval = interval
+        try:
+            # Keep counting from the existing file's age across restarts
+            self.rollover_at = os.path.getmtime(self.baseFilename) + interval
+        except OSError:
+            self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time.time() >= self.rollover_at:
+            return os.path.exists(self.baseFilename)
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most burst debug records per call site per interval.
+
+    High-frequency lines (cache hits, stream URLs) would otherwise flood
+    the log at DEBUG level. Suppressed records are counted and the count
+    is appended to the next record that gets through.
+    """
+
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, interval: float = LOG_SAMPLE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._sites: dict[tuple, list] = {}  # (path, line) -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= self.interval:
+                suppressed = site[2]
+                site[:] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} ({suppressed} similar lines suppressed)"
+                    record.args = None
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them rather than blocking when it falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer thread can format in-process records itself; only records
+        # bound for another process need flattening into something picklable
+        return record if isinstance(self.queue, queue.Queue) else super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(log_queue=None) -> Optional[logging.handlers.QueueListener]:
+    """Route all logging through a queue so callers never wait on disk or console I/O.
+
+    Without log_queue the file and console handlers run on a background
+    listener thread, which is returned. Cluster workers pass the
+    supervisor's queue instead, so one process owns the log file.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = None
+    if log_queue is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT)
+        handlers = [logging.StreamHandler()]
+        if LOG_FILE:
+            handlers.append(RotatingLogHandler(LOG_FILE, LOG_MAX_MB * 1024 * 1024, LOG_BACKUPS,
+                                               LOG_ROTATE_HOURS * 3600))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        listener = logging.handlers.QueueListener(log_queue, *handlers)
+        listener.start()
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    root.addHandler(handler)
+    return listener
+
+
+log_listener = setup_logging()
+atexit.register(lambda: log_listener and log_listener.stop())  # flush queued records on exit
+logger = logging.getLogger(__name__)
+
+# ─── Configuration ────────────────────────────────────────────────────────────────
+TOKEN = os.getenv("DISCORD_TOKEN")
+CURRENT_VERSION = "1.4.6"
+GITHUB_CHANGELOG_URL = "https://raw.githubusercontent.com/ghcr96/musicbot/main/CHANGELOG.md"
+CHANGELOG_TTL = 300  # seconds a fetched changelog is reused before asking GitHub again
+HTTP_TIMEOUT = 15  # seconds for outbound HTTP requests
+
+if not TOKEN:
+    logger.error("DISCORD_TOKEN not found in environment variables.")
+    logger.error("Please create a .env file with your Discord bot token:")
+    logger.error("DISCORD_TOKEN=your_bot_token_here")
+    exit(1)
+
+YTDL_OPTIONS = {
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    "default_search": "ytsearch",
+    "quiet": True,
+}
+# Flat extraction lists playlist entries (id, title, duration) without
+# resolving each one's formats
+YTDL_FLAT_OPTIONS = {
+    **YTDL_OPTIONS,
+    "noplaylist": False,
+    "extract_flat": "in_playlist",
+    "lazy_playlist": True,
+}
+FFMPEG_OPTIONS = {
+    "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+    "options": "-vn",
+}
+
+# Explicit FFmpeg executable path
+FFMPEG_EXECUTABLE = "/usr/bin/ffmpeg"
+
+# "opus" hands Opus packets straight to Discord (stream copy when the source is
+# already Opus, FFmpeg applies volume); "pcm" decodes to PCM and scales in Python
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "opus")
+OPUS_BITRATE = 128  # kbps cap when FFmpeg has to encode Opus
+AUDIO_READAHEAD_SECONDS = float(os.getenv("AUDIO_READAHEAD_SECONDS", "2"))  # audio buffered ahead of playback (0 disables)
+
+# PCM-mode DSP (needs numpy): loudness normalization, soft limiter and volume ramps
+AUDIO_NORMALIZE = os.getenv("AUDIO_NORMALIZE", "1") != "0"
+NORMALIZE_TARGET_DBFS = float(os.getenv("NORMALIZE_TARGET_DBFS", "-18"))  # RMS level tracks are brought to
+NORMALIZE_MAX_GAIN = 4.0  # never boost a quiet track by more than +12 dB
+NORMALIZE_MIN_SECONDS = 30  # audio a full play must measure before its level is cached
+NORMALIZE_GATE = 10 ** (-70 / 20)  # batches quieter than -70 dBFS RMS (silence, fades) aren't measured
+DSP_BATCH_FRAMES = 5  # 20 ms frames processed per NumPy batch
+VOLUME_RAMP_SECONDS = 0.3  # time for a volume or normalization change to fade in
+LIMITER_THRESHOLD = 0.8  # fraction of full scale where the soft limiter starts bending peaks
+
+# Resolver pool: yt-dlp extractions run in worker threads (or processes) so a
+# slow search never blocks the event loop
+RESOLVER_MODE = os.getenv("RESOLVER_MODE", "thread")  # "thread" or "process"
+RESOLVER_WORKERS = int(os.getenv("RESOLVER_WORKERS", "4"))
+RESOLVER_GUILD_LIMIT = int(os.getenv("RESOLVER_GUILD_LIMIT", "2"))  # concurrent lookups per guild
+RESOLVER_TIMEOUT = float(os.getenv("RESOLVER_TIMEOUT", "30"))  # seconds
+
+# Resolve cache: repeat lookups skip the search and reuse still-valid stream URLs
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "4096"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "86400"))  # seconds for query and metadata entries
+STREAM_URL_TTL = 3600  # fallback lifetime when a stream URL has no expire= parameter
+STREAM_URL_MARGIN = 300  # refresh stream URLs this many seconds before they expire
+
+# Prefetching: keep upcoming tracks resolved and start FFmpeg for the next one
+# shortly before the current track ends
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "2"))  # upcoming tracks kept resolved
+PREFETCH_LEAD = float(os.getenv("PREFETCH_LEAD", "10"))  # seconds before track end to prime the next one
+PREFETCH_INTERVAL = 2  # seconds between prefetch checks
+
+# Mid-stream recovery: a track that stops early (e.g. its stream URL expired or
+# returned 403) is re-resolved and restarted where it left off
+STREAM_RETRY_LIMIT = int(os.getenv("STREAM_RETRY_LIMIT", "3"))  # restarts per track
+STREAM_RETRY_DELAY = 1  # seconds before the first restart, doubled for each further one
+STREAM_END_TOLERANCE = 5  # seconds short of its duration a track may end and still count as finished
+
+# Playlists are listed with flat extraction and each entry is resolved only
+# when it nears the head of the queue
+PLAYLIST_LIMIT = int(os.getenv("PLAYLIST_LIMIT", "500"))  # max entries queued from one playlist
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "5"))  # candidates shown by .search
+SEARCH_TTL = 300  # seconds a user's .search results stay pickable
+
+# On-disk audio cache for popular tracks; disabled unless AUDIO_CACHE_DIR is set
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048"))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))  # plays before a track is saved
+AUDIO_CACHE_DOWNLOADS = 2  # concurrent cache downloads
+AUDIO_CACHE_TRACKED_PLAYS = 10000  # uncached tracks whose play counts are remembered
+
+# Local music library, searched before YouTube ("" disables)
+LIBRARY_DIR = os.getenv("LIBRARY_DIR", "")
+LIBRARY_INDEX = os.getenv("LIBRARY_INDEX", "meep_library.db")  # SQLite index of the library's files and tags
+LIBRARY_RESCAN_MINUTES = int(os.getenv("LIBRARY_RESCAN_MINUTES", "60"))  # unchanged files are skipped by mtime/size
+LIBRARY_MIN_SCORE = float(os.getenv("LIBRARY_MIN_SCORE", "0.75"))  # 0-1 similarity a local match needs to win
+LIBRARY_EXTENSIONS = frozenset((".mp3", ".flac", ".ogg", ".opus", ".m4a", ".aac", ".wav", ".webm", ".wma"))
+LIBRARY_CANDIDATES = 50  # index hits re-ranked per search
+LIBRARY_BATCH = 500  # files written per scan transaction
+
+# Queues, settings and playback positions survive restarts in this SQLite file ("" disables)
+STATE_DB = os.getenv("STATE_DB", "meep_state.db")
+STATE_FLUSH_INTERVAL = 5  # seconds between batched state writes
+
+# Admission control: each playing guild holds a session (voice connection + FFmpeg)
+SESSION_LIMIT = int(os.getenv("SESSION_LIMIT", "50"))  # concurrent sessions per process (0 = unlimited)
+MEMORY_LIMIT_MB = int(os.getenv("MEMORY_LIMIT_MB", "0"))  # stop admitting sessions above this RSS (0 = off)
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", "300"))  # seconds before leaving a silent or empty voice channel
+PAUSED_TIMEOUT = 900  # seconds a paused session may hold its slot
+REAPER_INTERVAL = 30  # seconds between idle checks and process accounting
+
+# Sharding: SHARD_COUNT="auto" asks Discord for the recommended count; unset
+# runs a single shard. CLUSTER_WORKERS > 1 spreads the shards across that many
+# worker processes under a supervisor that restarts crashed workers.
+SHARD_COUNT = os.getenv("SHARD_COUNT", "")
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+CLUSTER_STATUS_INTERVAL = 30  # seconds between worker status reports
+CLUSTER_RESTART_MAX_DELAY = 300  # seconds; restart backoff cap for a crash-looping worker
+IDENTIFY_DELAY = 5  # seconds Discord requires between shard identifies
+
+# Metrics: Prometheus text format on METRICS_HOST:METRICS_PORT (0 disables the
+# endpoint; cluster workers add their worker number to the port)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5  # seconds between event-loop lag probes
+LOOP_LAG_WARNING = 0.25  # seconds of lag worth a log line
+
+# Presence is global to the bot; Discord only accepts a handful of updates per minute
+PRESENCE_MODE = os.getenv("PRESENCE_MODE", "auto").lower()  # "auto", "rotate" or "static"
+PRESENCE_IDLE_TEXT = ".help for commands"
+PRESENCE_DEBOUNCE = 2  # seconds to let a burst of status changes settle
+PRESENCE_MIN_INTERVAL = 15  # seconds between presence updates
+PRESENCE_ROTATE_INTERVAL = 60  # seconds each status is shown in "rotate" mode
+
+MESSAGE_LIMIT = 2000  # Discord's maximum message length
+MESSAGE_COALESCE = 0.5  # seconds to collect a burst of messages before sending
+MESSAGE_RATE = 5  # messages (or edits) per channel ...
+MESSAGE_RATE_WINDOW = 5  # ... per this many seconds, matching Discord's channel bucket
+QUEUE_PAGE_SIZE = 10  # tracks per .queue page
+
+# Enable required intents for voice functionality
+intents = discord.Intents.default()
+intents.message_content = True
+intents.voice_states = True
+intents.guilds = True
+
+
+
+# ─── Resolver ───────────────────────────────────────────────────────────────────
+_worker_state = threading.local()
+
+
+def load_ytdl():
+    """Import yt-dlp on first use; it is only needed once something is looked up"""
+    import yt_dlp
+    return yt_dlp
+
+
+def download_errors() -> tuple:
+    """yt-dlp's DownloadError for except clauses, or () while yt-dlp isn't loaded (nothing can have raised it)"""
+    utils = sys.modules.get("yt_dlp.utils")
+    return (utils.DownloadError,) if utils is not None else ()
+
+
+_numpy_checked = False
+
+
+def load_numpy():
+    """Import numpy on first use; None when it isn't installed"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        # Threads that get here together all import; the import lock makes them wait for
+        # the one doing the work. Only then is the flag set, so nobody sees it with np unset
+        try:
+            import numpy
+            np = numpy
+        except ImportError:  # optional: without it the PCM path uses PCMVolumeTransformer
+            pass
+        _numpy_checked = True
+    return np
+
+
+def _get_ytdl(flat: bool = False) -> "YoutubeDL":
+    """Return this worker's YoutubeDL instance, creating it on first use."""
+    attr = "ytdl_flat" if flat else "ytdl"
+    ytdl = getattr(_worker_state, attr, None)
+    if ytdl is None:
+        ytdl = load_ytdl().YoutubeDL(YTDL_FLAT_OPTIONS if flat else YTDL_OPTIONS)
+        setattr(_worker_state, attr, ytdl)
+    return ytdl
+
+
+def _warm_worker():
+    """Build a worker's YoutubeDL ahead of its first lookup"""
+    _get_ytdl()
+
+
+def is_playlist_url(query: str) -> bool:
+    """True for YouTube playlist page URLs (watch URLs keep playing a single video)"""
+    if not query.startswith(("http://", "https://")):
+        return False
+    parsed = urlparse(query)
+    return (parsed.netloc.lower().endswith("youtube.com") and parsed.path == "/playlist"
+            and "list" in parse_qs(parsed.query))
+
+
+def select_audio_format(info: dict) -> Optional[dict]:
+    """Pick the best audio-only stream from an extracted info dict"""
+    formats = [f for f in info.get("formats", [])
+               if f.get("acodec") != "none" and f.get("vcodec") == "none"]
+    if not formats:
+        return None
+    if PLAYBACK_MODE == "opus":
+        # Opus streams can be passed through to Discord without re-encoding
+        return max(formats, key=lambda f: (f.get("acodec") == "opus", f.get("abr") or 0))
+    return max(formats, key=lambda f: f.get("abr") or 0)
+
+
+def _resolve_in_worker(query: str) -> Optional[dict]:
+    """Extract a query and return a compact track description.
+
+    Runs inside the resolver pool, so it must stay a picklable module-level
+    function. Only the fields playback needs are returned to keep the result
+    cheap to send back from a worker process.
+    """
+    info = _get_ytdl().extract_info(query, download=False)
+    if "entries" in info:
+        entries = list(info["entries"] or [])
+        if not entries:
+            return None
+        info = entries[0]
+
+    best = select_audio_format(info)
+    if best is None:
+        return None
+    return {
+        "id": info.get("id"),
+        "title": info.get("title", "Unknown"),
+        "url": best["url"],
+        "expires": stream_url_expiry(best["url"]),
+        "duration": info.get("duration"),
+        "acodec": best.get("acodec"),
+        "abr": best.get("abr"),
+    }
+
+
+def _search_in_worker(query: str, count: int) -> list:
+    """Flat YouTube search: IDs, titles and durations only, no format lookups."""
+    info = _get_ytdl(flat=True).extract_info(f"ytsearch{count}:{query}", download=False)
+    return [{"id": entry["id"], "title": entry.get("title") or "Unknown", "duration": entry.get("duration")}
+            for entry in (info or {}).get("entries") or [] if entry and entry.get("id")]
+
+
+# ─── Metrics ────────────────────────────────────────────────────────────────────
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Prometheus-style histogram that also keeps recent samples for percentiles."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: deque = deque(maxlen=1024)
+        self._lock = threading.Lock()  # observed from audio threads too
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.recent.append(value)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self.recent)
+        if not ordered:
+            return None
+        return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """Registry of histograms and gauges rendered in Prometheus text format.
+
+    Gauges are callables evaluated at scrape time; a gauge may return a
+    number or a dict mapping a label value to a number.
+    """
+
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, tuple] = {}  # name -> (help, label, callable)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help_text, buckets)
+        return self.histograms[name]
+
+    def gauge(self, name: str, help_text: str, func, label: Optional[str] = None):
+        self.gauges[name] = (help_text, label, func)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines += histogram.render()
+        for name, (help_text, label, func) in self.gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug(f"Gauge {name} failed: {e}")
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            if isinstance(value, dict):
+                lines += [f'{name}{{{label}="{key}"}} {val}' for key, val in value.items()]
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+RESOLVE_SECONDS = metrics.histogram("meep_resolve_seconds", "Duration of yt-dlp extractions")
+PLAY_TO_FIRST_FRAME_SECONDS = metrics.histogram(
+    "meep_play_to_first_frame_seconds", "Time from a .play command to the first audio frame being read")
+FFMPEG_SPAWN_SECONDS = metrics.histogram("meep_ffmpeg_spawn_seconds", "Time to start an FFmpeg process")
+LOOP_LAG_SECONDS = metrics.histogram(
+    "meep_event_loop_lag_seconds", "Event-loop scheduling delay measured by the watchdog",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+class FirstFrameMixin:
+    """Calls on_first_frame (once) when the audio player reads the first frame"""
+
+    on_first_frame = None
+
+    def read(self) -> bytes:
+        data = super().read()
+        callback = self.on_first_frame
+        if callback is not None:
+            self.on_first_frame = None
+            callback()
+        return data
+
+
+class MeteredPCMSource(FirstFrameMixin, PCMVolumeTransformer):
+    pass
+
+
+class MeteredOpusSource(FirstFrameMixin, discord.FFmpegOpusAudio):
+    pass
+
+
+class ReadAheadSource(discord.AudioSource):
+    """Reads another source's frames on a background thread into a ring buffer.
+
+    The ring is preallocated with AUDIO_READAHEAD_SECONDS of 20 ms slots,
+    so a moment where the audio thread can't get the GIL or FFmpeg is
+    slow is absorbed by buffered audio instead of being heard as a
+    stutter. Once the ring is full the reader waits until it has drained
+    to half, so it wakes in batches rather than every frame. read() copies
+    the slot out because discord.py's encoder and packet code need bytes.
+
+    underruns counts reads that found the ring empty mid-track. There is
+    no overrun counter: a full ring is the steady state while a track
+    plays, and the reader blocks rather than dropping frames, so it never
+    overflows.
+    """
+
+    PCM_SLOT_SIZE = discord.opus.Encoder.FRAME_SIZE  # one 20 ms frame of 48 kHz stereo PCM
+    OPUS_SLOT_SIZE = 1500  # 20 ms Opus packets are at most 1275 bytes
+
+    total_underruns = 0
+    _totals_lock = threading.Lock()
+
+    def __init__(self, original: discord.AudioSource, seconds: float = AUDIO_READAHEAD_SECONDS):
+        self.original = original
+        self.slots = max(int(seconds * 50), 2)
+        self.slot_size = self.OPUS_SLOT_SIZE if original.is_opus() else self.PCM_SLOT_SIZE
+        self._ring = memoryview(bytearray(self.slots * self.slot_size))
+        self._lengths = [0] * self.slots
+        self._oversize: dict[int, bytes] = {}  # slot -> frame too big for it (rare)
+        self._head = 0  # next slot to read
+        self._filled = 0
+        self._cond = threading.Condition()
+        self._eof = False
+        self._closed = False
+        self._playing = False
+        self.underruns = 0
+        threading.Thread(target=self._fill, name="readahead", daemon=True).start()
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def read(self) -> bytes:
+        with self._cond:
+            if not self._filled and not self._eof:
+                if self._playing:
+                    self.underruns += 1
+                    self._count("total_underruns")
+                while not self._filled and not (self._eof or self._closed):
+                    self._cond.wait()
+            if not self._filled:
+                return b""
+            slot = self._head
+            data = self._oversize.pop(slot, None)
+            if data is None:
+                start = slot * self.slot_size
+                data = bytes(self._ring[start:start + self._lengths[slot]])
+            self._head = (slot + 1) % self.slots
+            self._filled -= 1
+            self._playing = True
+            if self._filled == self.slots // 2:
+                self._cond.notify_all()
+        return data
+
+    def cleanup(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.original.cleanup()
+
+    def _fill(self):
+        try:
+            while True:
+                data = self.original.read()
+                with self._cond:
+                    if self._filled == self.slots:
+                        while self._filled > self.slots // 2 and not self._closed:
+                            self._cond.wait()
+                    if self._closed or not data:
+                        return
+                    slot = (self._head + self._filled) % self.slots
+                    if len(data) > self.slot_size:
+                        self._oversize[slot] = data
+                    else:
+                        start = slot * self.slot_size
+                        self._ring[start:start + len(data)] = data
+                    self._lengths[slot] = len(data)
+                    self._filled += 1
+                    self._cond.notify_all()
+        except Exception as e:
+            if not self._closed:
+                logger.warning(f"Read-ahead reader stopped: {e}")
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    @classmethod
+    def _count(cls, name: str):
+        with cls._totals_lock:
+            setattr(cls, name, getattr(cls, name) + 1)
+
+
+class MeteredReadAheadSource(FirstFrameMixin, ReadAheadSource):
+    pass
+
+
+class DSPSource(discord.AudioSource):
+    """NumPy volume stage for the PCM path, replacing PCMVolumeTransformer.
+
+    Frames are pulled DSP_BATCH_FRAMES at a time and processed as one
+    array: gain (volume x the track's normalization factor) moves towards
+    its target over VOLUME_RAMP_SECONDS instead of jumping, and when the
+    gain boosts the signal a tanh soft knee bends peaks above
+    LIMITER_THRESHOLD instead of clipping them. At unity gain frames pass
+    through untouched.
+
+    The normalization factor comes from the track's RMS level over the
+    whole stream, a cheap stand-in for ReplayGain/R128 loudness (silence
+    is gated out, but there is no K-weighting). A play from the start
+    measures it and caches it by video ID when the stream ends, and the
+    next play applies it from its first frame. A level taken from only the
+    intro would over-boost quiet openings. First plays, skipped plays and
+    plays shorter than NORMALIZE_MIN_SECONDS stay at unity gain.
+    """
+
+    def __init__(self, original: discord.AudioSource, volume: float = 1.0,
+                 track_id: Optional[str] = None, loudness: Optional["LRUCache"] = None,
+                 measure: bool = True):
+        if original.is_opus():
+            raise discord.ClientException("DSPSource needs a PCM source")
+        self.original = original
+        self.volume = volume
+        self.track_id = track_id
+        self.loudness = loudness
+        factor = loudness.get(track_id) if (AUDIO_NORMALIZE and loudness is not None and track_id) else None
+        self.normalization = factor or 1.0
+        self._measuring = (measure and AUDIO_NORMALIZE and factor is None
+                           and loudness is not None and track_id is not None)
+        self._sum_squares = 0.0
+        self._measured = 0
+        self._gain = self.target_gain  # gain at the end of the last batch
+        self._ramp_from = self._gain
+        self._ramp_to = self._gain
+        self._frames: deque = deque()
+
+    @property
+    def target_gain(self) -> float:
+        return self.volume * self.normalization
+
+    def is_opus(self) -> bool:
+        return False
+
+    def read(self) -> bytes:
+        if not self._frames:
+            self._process_batch()
+        return self._frames.popleft() if self._frames else b""
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def _process_batch(self):
+        frame_size = discord.opus.Encoder.FRAME_SIZE
+        raw = []
+        ended = False
+        for _ in range(DSP_BATCH_FRAMES):
+            data = self.original.read()
+            if len(data) != frame_size:
+                ended = True
+                break
+            raw.append(data)
+        if self._measuring:
+            if raw:
+                self._measure(raw)
+            if ended:
+                self._store_loudness()
+        if not raw:
+            return
+        target = self.target_gain
+        if target != self._ramp_to:
+            self._ramp_from, self._ramp_to = self._gain, target
+        if self._gain == target == 1.0:
+            self._frames.extend(raw)
+            return
+
+        samples = np.frombuffer(b"".join(raw), dtype=np.int16).astype(np.float32).reshape(-1, 2)
+        samples *= 1 / 32768
+        start = self._gain
+        if start != target:
+            step = abs(self._ramp_to - self._ramp_from) * len(raw) * 0.02 / VOLUME_RAMP_SECONDS
+            self._gain = min(start + step, target) if target > start else max(start - step, target)
+            samples *= np.linspace(start, self._gain, len(samples), dtype=np.float32)[:, None]
+        else:
+            samples *= start
+        if max(start, self._gain) > 1.0:
+            self._limit(samples)
+        pcm = (samples * 32767).astype(np.int16).tobytes()
+        self._frames.extend(pcm[i:i + frame_size] for i in range(0, len(pcm), frame_size))
+
+    @staticmethod
+    def _limit(samples):
+        """Soft-knee limiter: samples above the threshold are bent towards full scale with tanh"""
+        knee = 1.0 - LIMITER_THRESHOLD
+        magnitude = np.abs(samples)
+        over = magnitude > LIMITER_THRESHOLD
+        if over.any():
+            bent = LIMITER_THRESHOLD + knee * np.tanh((magnitude[over] - LIMITER_THRESHOLD) / knee)
+            samples[over] = np.copysign(bent, samples[over])
+
+    def _measure(self, raw: list):
+        samples = np.frombuffer(b"".join(raw), dtype=np.int16).astype(np.float32)
+        sum_squares = float(np.dot(samples, samples))
+        if sum_squares < len(samples) * (NORMALIZE_GATE * 32768) ** 2:
+            return  # silence and fades would drag the average down
+        self._sum_squares += sum_squares
+        self._measured += len(samples)
+
+    def _store_loudness(self):
+        """Cache the normalization factor for the next play, once the stream has ended"""
+        self._measuring = False
+        if self._measured < NORMALIZE_MIN_SECONDS * 48000 * 2:
+            return  # too little audio to judge the track by
+        level = 20 * np.log10((self._sum_squares / self._measured) ** 0.5 / 32768)
+        factor = float(min(max(10 ** ((NORMALIZE_TARGET_DBFS - level) / 20), 1 / NORMALIZE_MAX_GAIN),
+                           NORMALIZE_MAX_GAIN))
+        self.loudness.set(self.track_id, factor)
+        logger.debug(f"Loudness of {self.track_id}: {level:.1f} dBFS RMS, gain x{factor:.2f} from the next play")
+
+
+class MeteredDSPSource(FirstFrameMixin, DSPSource):
+    pass
+
+
+# Sources whose volume attribute can be changed while playing
+VOLUME_SOURCES = (PCMVolumeTransformer, DSPSource)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve metrics.render() at /metrics"""
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return runner
+
+
+# ─── Resolve Cache ──────────────────────────────────────────────────────────────
+_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+
+def extract_video_id(query: str) -> Optional[str]:
+    """Return the YouTube video ID if the query is a video URL"""
+    if not query.startswith(("http://", "https://")):
+        return None
+    parsed = urlparse(query)
+    host = parsed.netloc.lower()
+    if host.endswith("youtu.be"):
+        video_id = parsed.path.lstrip("/").split("/")[0]
+    elif host.endswith("youtube.com") or host.endswith("youtube-nocookie.com"):
+        if parsed.path == "/watch":
+            video_id = parse_qs(parsed.query).get("v", [""])[0]
+        else:
+            parts = parsed.path.strip("/").split("/")
+            video_id = parts[1] if len(parts) > 1 and parts[0] in ("shorts", "embed", "live") else ""
+    else:
+        return None
+    return video_id if _VIDEO_ID_RE.match(video_id) else None
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query so trivially different spellings share a cache entry"""
+    return " ".join(query.split()).casefold()
+
+
+def stream_url_expiry(url: str) -> float:
+    """Return the unix time a googlevideo stream URL stops working"""
+    expire = parse_qs(urlparse(url).query).get("expire")
+    if expire and expire[0].isdigit():
+        return float(expire[0])
+    return time.time() + STREAM_URL_TTL
+
+
+class LRUCache:
+    """Size-bounded LRU map with per-entry expiry and hit/miss counters."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()  # some caches are also used from audio and worker threads
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, expires_at: Optional[float] = None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResolveCache:
+    """Caches the stages of a lookup separately.
+
+    Queries map to video IDs, video IDs map to title/format metadata, and
+    stream URLs are kept only until shortly before their expire= time. A
+    repeat query whose stream URL has expired can then be re-resolved by
+    video ID without running the search again.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.queries = LRUCache(max_entries, ttl)
+        self.metadata = LRUCache(max_entries, ttl)
+        self.streams = LRUCache(max_entries, ttl)
+
+    def video_id_for(self, query: str) -> Optional[str]:
+        return extract_video_id(query) or self.queries.get(normalize_query(query))
+
+    def get(self, video_id: str) -> Optional[dict]:
+        """Return a full track dict if both metadata and a fresh stream URL are cached"""
+        meta = self.metadata.get(video_id)
+        if meta is None:
+            return None
+        url = self.streams.get(video_id)
+        if url is None:
+            return None
+        return dict(meta, url=url, expires=stream_url_expiry(url))
+
+    def store(self, query: str, track: dict):
+        video_id = track.get("id")
+        if not video_id:
+            return
+        if not extract_video_id(query):
+            self.queries.set(normalize_query(query), video_id)
+        self.metadata.set(video_id, {k: v for k, v in track.items() if k not in ("url", "expires")})
+        self.streams.set(video_id, track["url"], track["expires"] - STREAM_URL_MARGIN)
+
+    def invalidate_stream(self, video_id: str):
+        """Forget a stream URL that stopped working before its expiry"""
+        self.streams.pop(video_id)
+
+    def stats(self) -> dict:
+        return {
+            name: {"size": len(cache), "hits": cache.hits, "misses": cache.misses}
+            for name, cache in (("queries", self.queries), ("metadata", self.metadata), ("streams", self.streams))
+        }
+
+
+class Resolver:
+    """Runs yt-dlp extractions in a bounded worker pool.
+
+    A global semaphore caps lookups across the whole bot and a per-guild
+    semaphore stops one guild from hogging every worker. Each lookup is
+    bounded by a timeout; cancelling the awaiting coroutine abandons the
+    result (a lookup already running in a worker finishes in the background).
+    Results go through a ResolveCache so repeat requests skip the pool, and
+    identical concurrent requests are coalesced into a single extraction.
+    """
+
+    def __init__(self, mode: str = RESOLVER_MODE, workers: int = RESOLVER_WORKERS,
+                 guild_limit: int = RESOLVER_GUILD_LIMIT, timeout: float = RESOLVER_TIMEOUT):
+        if mode == "process":
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="resolver"
+            )
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self.guild_limit = guild_limit
+        self._global_limit = asyncio.Semaphore(workers)
+        self._guild_limits: dict[int, asyncio.Semaphore] = {}
+        # Playlist listings stream entries back as they are fetched, which only
+        # works from threads, and are kept off the lookup workers
+        self._playlist_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="playlist"
+        )
+        self.cache = ResolveCache()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._waiters: dict[str, int] = {}
+        self.coalesced = 0  # total requests that joined another request's lookup
+        logger.info(f"Resolver started: {workers} {mode} workers, {guild_limit} per guild, {timeout}s timeout")
+
+    async def resolve(self, query: str, guild_id: Optional[int] = None) -> Optional[dict]:
+        """Resolve a query to a track dict, or None if nothing playable was found.
+
+        Raises DownloadError from yt-dlp and asyncio.TimeoutError when the
+        lookup takes longer than the configured timeout.
+        """
+        lookup = query
+        video_id = self.cache.video_id_for(query)
+        if video_id:
+            track = self.cache.get(video_id)
+            if track is not None:
+                logger.debug(f"Resolve cache hit for {query!r} -> {video_id}")
+                return track
+            # Known video whose stream URL expired: skip the search
+            lookup = f"https://www.youtube.com/watch?v={video_id}"
+
+        # Single-flight: concurrent requests for the same video or query share
+        # one extraction instead of each hitting YouTube
+        key = video_id or f"query:{normalize_query(query)}"
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._extract(lookup, guild_id))
+            self._inflight[key] = flight
+            self._waiters[key] = 0
+            flight.add_done_callback(lambda f: self._land(key, query, f))
+        else:
+            self._waiters[key] += 1
+            self.coalesced += 1
+            logger.debug(f"Joined in-flight lookup for {query!r} ({self._waiters[key]} waiting)")
+
+        # Shield the shared task so one cancelled caller doesn't cancel the rest
+        track = await asyncio.shield(flight)
+        return dict(track) if track is not None else None
+
+    def _land(self, key: str, query: str, flight: asyncio.Future):
+        """Cache a finished shared lookup and report how many callers it served"""
+        self._inflight.pop(key, None)
+        waiters = self._waiters.pop(key, 0)
+        if flight.cancelled():
+            return
+        if flight.exception() is None and flight.result() is not None:
+            self.cache.store(query, flight.result())
+        if waiters:
+            logger.info(f"Lookup for {query!r} served {waiters} coalesced waiter(s)")
+
+    async def search(self, query: str, count: int = SEARCH_RESULTS, guild_id: Optional[int] = None) -> list:
+        """Flat search returning up to count candidates with id, title and duration.
+
+        Much cheaper than resolve(): no formats are fetched, so a candidate
+        needs a resolve() of its watch URL before it can be played.
+        """
+        return await self._extract(query, guild_id, _search_in_worker, count)
+
+    async def _extract(self, query: str, guild_id: Optional[int], func=None, *args):
+        """Run one extraction (func, _resolve_in_worker by default) in the pool under the concurrency limits"""
+        func = func or _resolve_in_worker
+        guild_limit = None
+        if guild_id is not None:
+            guild_limit = self._guild_limits.setdefault(guild_id, asyncio.Semaphore(self.guild_limit))
+            await guild_limit.acquire()
+        try:
+            async with self._global_limit:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self._executor, func, query, *args)
+                started = time.perf_counter()
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Resolver timed out after {self.timeout}s for query: {query}")
+                    raise
+                finally:
+                    RESOLVE_SECONDS.observe(time.perf_counter() - started)
+        finally:
+            if guild_limit is not None:
+                guild_limit.release()
+
+    async def iter_playlist(self, url: str, limit: int = PLAYLIST_LIMIT):
+        """Yield flat playlist entries as yt-dlp pages through the playlist.
+
+        Entries are dicts with id, title and duration only; their streams are
+        resolved later. Stopping iteration early stops the listing thread.
+        """
+        loop = asyncio.get_running_loop()
+        entries: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                info = _get_ytdl(flat=True).extract_info(url, download=False, process=False)
+                for count, entry in enumerate(info.get("entries") or []):
+                    if stop.is_set() or count >= limit:
+                        break
+                    if entry and entry.get("id"):
+                        compact = {"id": entry["id"], "title": entry.get("title") or "Unknown",
+                                   "duration": entry.get("duration")}
+                        loop.call_soon_threadsafe(entries.put_nowait, compact)
+            except Exception as e:
+                loop.call_soon_threadsafe(entries.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(entries.put_nowait, done)
+
+        loop.run_in_executor(self._playlist_executor, produce)
+        try:
+            while True:
+                item = await entries.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def warm_up(self):
+        """Load yt-dlp in the workers in the background so the first lookups don't pay for it"""
+        for _ in range(self.workers):
+            self._executor.submit(_warm_worker)
+
+    def close(self):
+        """Shut the worker pool down without waiting for running lookups."""
+        self._executor.shutdown(wait=False)
+        self._playlist_executor.shutdown(wait=False)
+
+
+# ─── Audio Cache ────────────────────────────────────────────────────────────────
+class AudioCache:
+    """Keeps frequently played tracks as local Opus files.
+
+    Tracks played AUDIO_CACHE_MIN_PLAYS times are downloaded in the
+    background to <video id>.opus. Files are written to a temporary name and
+    renamed into place, and the index (sizes, last use, play counts) is saved
+    the same way so it survives restarts. Least recently used files are
+    evicted once the directory exceeds its byte budget.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, min_plays: int = AUDIO_CACHE_MIN_PLAYS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.index_path = os.path.join(directory, "index.json")
+        self.entries: dict[str, dict] = {}  # video id -> {"size", "last_used", "plays"}
+        self.plays: OrderedDict = OrderedDict()  # play counts of tracks not cached yet
+        self._downloading: set[str] = set()
+        self._download_limit = asyncio.Semaphore(AUDIO_CACHE_DOWNLOADS)
+        self._tasks: set[asyncio.Task] = set()
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @property
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def path_for(self, video_id: str) -> str:
+        return os.path.join(self.directory, f"{video_id}.opus")
+
+    def lookup(self, video_id: Optional[str]) -> Optional[str]:
+        """Return the local file for a track if it is cached"""
+        entry = self.entries.get(video_id) if video_id else None
+        if entry is None:
+            return None
+        path = self.path_for(video_id)
+        if not os.path.exists(path):
+            del self.entries[video_id]
+            self._dirty = True
+            return None
+        entry["last_used"] = time.time()
+        self._dirty = True
+        return path
+
+    def record_play(self, track: "Track"):
+        """Count a play and start caching the track once it is popular enough"""
+        if not track.id:
+            return
+        if track.id in self.entries:
+            self.entries[track.id]["plays"] += 1
+            self._dirty = True
+            return
+        plays = self.plays.pop(track.id, 0) + 1
+        self.plays[track.id] = plays
+        while len(self.plays) > AUDIO_CACHE_TRACKED_PLAYS:
+            self.plays.popitem(last=False)
+        self._dirty = True
+        if plays >= self.min_plays and track.id not in self._downloading and track.url:
+            self._downloading.add(track.id)
+            task = asyncio.ensure_future(self._download(track.id, track.title, track.url, track.acodec))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _download(self, video_id: str, title: str, url: str, acodec: Optional[str]):
+        final = self.path_for(video_id)
+        tmp = final + ".tmp"
+        codec = ["-c:a", "copy"] if acodec == "opus" else ["-c:a", "libopus", "-b:a", f"{OPUS_BITRATE}k"]
+        try:
+            async with self._download_limit:
+                logger.info(f"Caching audio for: {title}")
+                proc = await asyncio.create_subprocess_exec(
+                    FFMPEG_EXECUTABLE, "-y", "-loglevel", "error",
+                    *FFMPEG_OPTIONS["before_options"].split(), "-i", url,
+                    "-vn", "-map_metadata", "-1", *codec, "-f", "opus", tmp,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate()
+            if proc.returncode != 0:
+                logger.warning(f"Audio cache download failed for {title}: {stderr.decode(errors='replace').strip()}")
+                return
+            os.replace(tmp, final)
+            self.entries[video_id] = {"size": os.path.getsize(final), "last_used": time.time(),
+                                      "plays": self.plays.pop(video_id, 0)}
+            self._dirty = True
+            self._evict()
+            self.save()
+            logger.info(f"Cached audio for: {title} ({self.entries.get(video_id, {}).get('size', 0)} bytes)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Audio cache download failed for {title}: {e}")
+        finally:
+            self._downloading.discard(video_id)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _evict(self):
+        """Delete least recently used files until the cache fits its budget"""
+        total = self.size
+        for video_id in sorted(self.entries, key=lambda v: self.entries[v]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            entry = self.entries.pop(video_id)
+            total -= entry["size"]
+            try:
+                os.remove(self.path_for(video_id))
+            except FileNotFoundError:
+                pass
+            logger.info(f"Evicted {video_id} from audio cache")
+        self._dirty = True
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Audio cache index unreadable, starting empty: {e}")
+            data = {}
+        self.entries = {v: e for v, e in data.get("entries", {}).items() if os.path.exists(self.path_for(v))}
+        self.plays = OrderedDict(data.get("plays", {}))
+        # Leftovers from downloads interrupted by a restart
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        logger.info(f"Audio cache loaded: {len(self.entries)} tracks, {self.size / 1e6:.1f} MB in {self.directory}")
+
+    def save(self):
+        """Write the index atomically if it changed"""
+        if not self._dirty:
+            return
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"entries": self.entries, "plays": self.plays}, f)
+        os.replace(tmp, self.index_path)
+        self._dirty = False
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self.save()
+
+
+# ─── Local Library ──────────────────────────────────────────────────────────────
+_mutagen_checked = False
+mutagen = None
+
+
+def load_mutagen():
+    """Import mutagen on first use; None when it isn't installed (tags then come from file names)"""
+    global mutagen, _mutagen_checked
+    if not _mutagen_checked:
+        try:  # flag set after the import, as in load_numpy, so scan threads never see a half-done check
+            import mutagen as module
+            mutagen = module
+        except ImportError:
+            pass
+        _mutagen_checked = True
+    return mutagen
+
+
+def read_tags(path: str) -> tuple:
+    """Return (title, artist, album, duration, codec) for an audio file.
+
+    Tags are read with mutagen when it is installed. Missing titles and
+    artists are taken from an "Artist - Title" file name, and the album
+    from the folder name.
+    """
+    stem, ext = os.path.splitext(os.path.basename(path))
+    codec = ext[1:].lower()
+    title = artist = album = duration = None
+    if load_mutagen() is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+        except Exception as e:
+            logger.debug(f"Could not read tags from {path}: {e}")
+            audio = None
+        if audio is not None:
+            tags = audio.tags or {}
+            title, artist, album = (next(iter(tags.get(key) or []), None) for key in ("title", "artist", "album"))
+            duration = getattr(audio.info, "length", None)
+            if type(audio).__name__ == "OggOpus":
+                codec = "opus"
+    if not title:
+        stem = re.sub(r"^\d+[\s.\-_]+", "", stem)  # leading track number
+        name_artist, sep, name_title = stem.partition(" - ")
+        title = name_title if sep else stem
+        artist = artist or (name_artist if sep else None)
+    album = album or os.path.basename(os.path.dirname(path))
+    return title, artist, album, duration, codec
+
+
+def trigrams(text: str) -> list:
+    """Distinct three-character pieces of each word, as the index's trigram tokenizer sees them"""
+    grams = dict.fromkeys(word[i:i + 3] for word in re.findall(r"\w+", text.casefold())
+                          for i in range(len(word) - 2))
+    return list(grams)
+
+
+class LocalLibrary:
+    """Searchable index of a folder of audio files, tried before YouTube.
+
+    scan() walks the folder and reads tags only from files whose mtime or
+    size changed since the last scan, so rescanning an unchanged library
+    costs one stat per file. Titles, artists and albums go into an SQLite
+    FTS5 trigram index that persists between runs. search() tries an exact
+    title or "artist title" first, then asks the index for files containing
+    every query word, any of them, or (for typos) any of their trigrams,
+    and re-ranks the best hits by string similarity. Lookups stay in the
+    millisecond range on 100k+ files.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            artist TEXT,
+            album TEXT,
+            duration REAL,
+            codec TEXT,
+            title_key TEXT NOT NULL,  -- normalize_query(title), for exact matches without the FTS index
+            full_key TEXT  -- normalize_query("artist title")
+        );
+        CREATE INDEX IF NOT EXISTS files_title_key ON files (title_key);
+        CREATE INDEX IF NOT EXISTS files_full_key ON files (full_key);
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            title, artist, album, content='files', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, title, artist, album)
+                VALUES ('delete', old.id, old.title, old.artist, old.album);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, title, artist, album)
+                VALUES ('delete', old.id, old.title, old.artist, old.album);
+            INSERT INTO files_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+        END;
+    """
+    COLUMNS = "path, title, artist, album, duration, codec"
+
+    def __init__(self, directory: str, index_path: str = LIBRARY_INDEX):
+        self.directory = os.path.abspath(directory)
+        self.index_path = index_path
+        # Scans write on their own thread so searches never queue behind a long walk
+        self._scan_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="library-scan")
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="library")
+        self._writer = self._connect()  # only used from the scan thread after this
+        self._writer.executescript(self.SCHEMA)
+        self._reader = self._connect()  # only used from the search thread
+        self.files = self._writer.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        self.scanning = False
+        self._closing = False
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.index_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    async def scan(self):
+        """Bring the index up to date with the folder"""
+        if self.scanning:
+            return
+        self.scanning = True
+        started = time.perf_counter()
+        try:
+            changed, removed = await asyncio.get_running_loop().run_in_executor(self._scan_executor, self._scan)
+        except OSError as e:
+            # Unmounted share, renamed folder, lost permissions: keep the index as it is
+            logger.warning(f"Library scan skipped, cannot read {self.directory}: {e}")
+            return
+        finally:
+            self.scanning = False
+        logger.info(f"Library scan of {self.directory}: {self.files} files, {changed} added or changed, "
+                    f"{removed} removed in {time.perf_counter() - started:.1f}s")
+
+    def _walk(self, unreadable: list):
+        """Yield (path, stat) for every audio file under the library folder.
+
+        Subfolders that can't be listed are added to unreadable; if the
+        library folder itself can't be listed, OSError is raised.
+        """
+        pending = [self.directory]
+        while pending:
+            folder = pending.pop()
+            try:
+                entries = list(os.scandir(folder))
+            except OSError as e:
+                if folder == self.directory:
+                    raise
+                logger.warning(f"Cannot read library folder: {e}")
+                unreadable.append(folder)
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in LIBRARY_EXTENSIONS:
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+
+    def _scan(self) -> tuple:
+        known = {path: (mtime, size) for path, mtime, size in self._writer.execute("SELECT path, mtime, size FROM files")}
+        batch, changed, found, unreadable = [], 0, 0, []
+        for path, st in self._walk(unreadable):
+            if self._closing:
+                return changed, 0  # unfinished walk: don't treat unvisited files as removed
+            found += 1
+            if known.pop(path, None) == (st.st_mtime, st.st_size):
+                continue
+            title, artist, album, duration, codec = read_tags(path)
+            full_key = normalize_query(f"{artist} {title}") if artist else None
+            batch.append((path, st.st_mtime, st.st_size, title, artist, album, duration, codec,
+                          normalize_query(title), full_key))
+            if len(batch) >= LIBRARY_BATCH:
+                changed += self._upsert(batch)
+                batch = []
+        changed += self._upsert(batch)
+        # Whatever is left in known was not found on disk, except under folders that couldn't be read
+        if unreadable:
+            prefixes = tuple(os.path.join(folder, "") for folder in unreadable)
+            known = {path: stat for path, stat in known.items() if not path.startswith(prefixes)}
+        if not found and known:
+            # An empty mount point looks like an emptied library; don't drop the index for it
+            logger.warning(f"Library folder {self.directory} is empty; keeping {len(known)} indexed files")
+            known = {}
+        with self._writer:
+            self._writer.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+        self.files = self._writer.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return changed, len(known)
+
+    def _upsert(self, rows: list) -> int:
+        with self._writer:
+            self._writer.executemany(
+                "INSERT INTO files (path, mtime, size, title, artist, album, duration, codec, title_key, full_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, "
+                "size = excluded.size, title = excluded.title, artist = excluded.artist, album = excluded.album, "
+                "duration = excluded.duration, codec = excluded.codec, title_key = excluded.title_key, "
+                "full_key = excluded.full_key",
+                rows,
+            )
+        return len(rows)
+
+    async def search(self, query: str, limit: int = SEARCH_RESULTS) -> list:
+        """Return up to limit library entries for query, best first, each with a 0-1 score"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._search, query, limit)
+
+    async def match(self, query: str) -> Optional[dict]:
+        """Return the best entry for query if it is a close enough match, else None"""
+        results = await self.search(query, 1)
+        if results and results[0]["score"] >= LIBRARY_MIN_SCORE:
+            self.hits += 1
+            return results[0]
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def _match_expressions(query: str) -> list:
+        """FTS queries to try in turn: every word, any whole word, then any trigram (typos)"""
+        words = [[f'"{gram}"' for gram in trigrams(word)] for word in re.findall(r"\w+", query)]
+        words = [" AND ".join(grams) for grams in words if grams]
+        if not words:
+            return []
+        every, any_word = " AND ".join(words), " OR ".join(f"({word})" for word in words)
+        any_gram = " OR ".join(f'"{gram}"' for gram in trigrams(query))
+        return list(dict.fromkeys((every, any_word, any_gram)))
+
+    def _search(self, query: str, limit: int) -> list:
+        wanted = normalize_query(query)
+        # An exact title or "artist title" needs only a B-tree lookup
+        rows = self._reader.execute(
+            f"SELECT {self.COLUMNS} FROM files WHERE title_key = ? OR full_key = ? LIMIT ?",
+            (wanted, wanted, LIBRARY_CANDIDATES),
+        ).fetchall()
+        expressions = self._match_expressions(query) if not rows else []
+        for expression in expressions:
+            rows = self._reader.execute(
+                f"SELECT {self.COLUMNS} FROM files WHERE id IN ("
+                f"SELECT rowid FROM files_fts WHERE files_fts MATCH ? ORDER BY rank LIMIT ?)",
+                (expression, LIBRARY_CANDIDATES),
+            ).fetchall()
+            if rows:
+                break
+        results = []
+        for path, title, artist, album, duration, codec in rows:
+            names = [title] + ([f"{artist} {title}", f"{title} {artist}"] if artist else [])
+            score = max(difflib.SequenceMatcher(None, wanted, normalize_query(name)).ratio() for name in names)
+            results.append({"path": path, "title": title, "artist": artist, "album": album,
+                            "duration": duration, "codec": codec, "score": score})
+        results.sort(key=lambda entry: entry["score"], reverse=True)
+        return results[:limit]
+
+    def owns(self, path: Optional[str]) -> bool:
+        """True for an existing file inside the library folder (e.g. a restored queue entry)"""
+        return bool(path) and path.startswith(self.directory + os.sep) and os.path.isfile(path)
+
+    def close(self):
+        self._closing = True
+        self._scan_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self._writer.close()
+        self._reader.close()
+
+
+# ─── Player State ───────────────────────────────────────────────────────────────
+class Track:
+    """A queued song. Slotted to keep long queues cheap."""
+
+    __slots__ = ("query", "id", "title", "duration", "url", "expires", "acodec", "abr", "path")
+
+    def __init__(self, query: Optional[str], id: Optional[str] = None, title: str = "Unknown",
+                 duration: Optional[float] = None, url: Optional[str] = None, expires: float = 0.0,
+                 acodec: Optional[str] = None, abr: Optional[float] = None):
+        self.query = query
+        self.id = id
+        self.title = title
+        self.duration = duration
+        self.url = url
+        self.expires = expires
+        self.acodec = acodec
+        self.abr = abr
+        self.path: Optional[str] = None  # local file, when the audio is cached on disk
+
+    @classmethod
+    def from_resolved(cls, query: str, info: dict) -> "Track":
+        """Build a track from a resolver result"""
+        return cls(query, info.get("id"), info.get("title", "Unknown"), info.get("duration"),
+                   info.get("url"), info.get("expires", 0.0), info.get("acodec"), info.get("abr"))
+
+    @classmethod
+    def from_library(cls, entry: dict) -> "Track":
+        """Build a track for a file in the local library"""
+        track = cls(entry["path"], None, entry["title"], entry["duration"], acodec=entry["codec"])
+        track.path = entry["path"]
+        return track
+
+    @property
+    def watch_url(self) -> str:
+        return f"https://www.youtube.com/watch?v={self.id}" if self.id else self.query
+
+    def __repr__(self):
+        return f"<Track {self.id} {self.title!r}>"
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """Format seconds as m:ss or h:mm:ss ("?:??" when unknown)"""
+    if not seconds:
+        return "?:??"
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+class GuildPlayer:
+    """All playback state for one guild.
+
+    The current track is held separately from the upcoming deque, so
+    advancing is O(1). Queue mutations happen under a lock because the
+    audio thread's after callback and the event loop both touch the state.
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.queue: deque = deque()  # upcoming Tracks
+        self.current: Optional[Track] = None
+        self.loop = False
+        self.volume = 1.0
+        self.voice: Optional[discord.VoiceClient] = None
+        self.channel: Optional[discord.abc.Messageable] = None  # where now-playing messages go
+        self.prefetcher: Optional["Prefetcher"] = None
+        self.skip_requested = False
+        self.generation = 0  # bumped on every track start so stale after callbacks are ignored
+        self.revision = 0  # bumped on every change the state store should save
+        self.idle_since: Optional[float] = None  # when the idle reaper first saw it silent
+        self.recoveries = 0  # stream restarts used by the current track
+        self.recovering = False  # waiting to restart the current track after a stream failure
+        self.starting = False  # looking up or spawning the current track before it plays
+        self._started_at = 0.0
+        self._paused_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def enqueue(self, track: Track) -> int:
+        """Add a track to the end of the queue and return its 1-based position"""
+        with self._lock:
+            self.queue.append(track)
+            self.revision += 1
+            return len(self.queue)
+
+    def advance(self) -> Optional[Track]:
+        """Make the next track current, honouring loop mode and pending skips"""
+        with self._lock:
+            self.recoveries = 0
+            if self.loop and self.current is not None and not self.skip_requested:
+                return self.current
+            self.skip_requested = False
+            self.current = self.queue.popleft() if self.queue else None
+            self.revision += 1
+            return self.current
+
+    def upcoming(self, count: int) -> list:
+        """The tracks that will play after the current one, in order"""
+        with self._lock:
+            if self.loop and self.current is not None and not self.skip_requested:
+                return [self.current] + list(islice(self.queue, max(count - 1, 0)))
+            return list(islice(self.queue, count))
+
+    def tracks(self) -> list:
+        """The current track (if any) followed by the whole queue"""
+        with self._lock:
+            return ([self.current] if self.current is not None else []) + list(self.queue)
+
+    def page(self, start: int, count: int) -> list:
+        """A slice of the upcoming queue, without copying the rest of it"""
+        with self._lock:
+            return list(islice(self.queue, start, start + count))
+
+    def remove(self, index: int) -> Track:
+        """Remove the track at a 0-based queue index"""
+        with self._lock:
+            track = self.queue[index]
+            del self.queue[index]
+            self.revision += 1
+            return track
+
+    def move(self, src: int, dst: int) -> Track:
+        """Move a track between 0-based queue indices"""
+        with self._lock:
+            track = self.queue[src]
+            del self.queue[src]
+            self.queue.insert(dst, track)
+            self.revision += 1
+            return track
+
+    def shuffle(self):
+        with self._lock:
+            items = list(self.queue)
+            random.shuffle(items)
+            self.queue = deque(items)
+            self.revision += 1
+
+    def clear(self):
+        with self._lock:
+            self.queue.clear()
+            self.revision += 1
+
+    def touch(self):
+        """Mark settings (loop, volume, channels) as changed"""
+        self.revision += 1
+
+    def reset(self):
+        """Forget the queue, current track and voice client (on stop or disconnect)"""
+        with self._lock:
+            self.voice = None  # a stale client would look like a session to the reaper
+            self.queue.clear()
+            self.current = None
+            self.skip_requested = False
+            self.generation += 1
+            self.revision += 1
+        self.close_prefetcher()
+
+    def close_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def track_started(self, offset: float = 0.0) -> int:
+        """Record the start of playback and return the new generation"""
+        with self._lock:
+            self.generation += 1
+            self._started_at = time.monotonic() - offset
+            self._paused_at = None
+            self.idle_since = None
+            return self.generation
+
+    def seeked(self, offset: float):
+        """Record that the current track continues from offset seconds"""
+        self._started_at = time.monotonic() - offset
+        if self._paused_at is not None:
+            self._paused_at = time.monotonic()
+
+    def pause(self):
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+
+    def resume(self):
+        if self._paused_at is not None:
+            self._started_at += time.monotonic() - self._paused_at
+            self._paused_at = None
+
+    @property
+    def paused(self) -> bool:
+        return self._paused_at is not None
+
+    @property
+    def position(self) -> float:
+        """Seconds played of the current track"""
+        now = self._paused_at or time.monotonic()
+        return now - self._started_at
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left in the current track, if its duration is known"""
+        if self.current is None or not self.current.duration:
+            return None
+        return self.current.duration - self.position
+
+
+# ─── Prefetcher ─────────────────────────────────────────────────────────────────
+class Prefetcher:
+    """Keeps a guild's upcoming tracks resolved and the next one primed.
+
+    Stream URLs of the next few tracks are refreshed through the resolver
+    before they expire. Shortly before the current track ends, FFmpeg is
+    spawned for the next track so the stream is already open and buffering
+    by the time the transition happens.
+    """
+
+    def __init__(self, resolver: Resolver, player: GuildPlayer, make_source,
+                 audio_cache: Optional[AudioCache] = None,
+                 depth: int = PREFETCH_DEPTH, lead: float = PREFETCH_LEAD):
+        self.resolver = resolver
+        self.audio_cache = audio_cache
+        self.player = player
+        self.depth = depth
+        self.lead = lead
+        self._make_source = make_source
+        self._primed: Optional[tuple] = None  # (track, source, volume)
+        self._wake = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def poke(self):
+        """Re-check the queue now instead of at the next interval"""
+        self._wake.set()
+
+    def take(self, track: Track) -> Optional[discord.AudioSource]:
+        """Hand over the primed source for a track, if one is ready"""
+        primed, self._primed = self._primed, None
+        if primed is None:
+            return None
+        primed_track, source, volume = primed
+        if primed_track is track and (track.path or track.expires > time.time()):
+            if isinstance(source, VOLUME_SOURCES):
+                source.volume = self.player.volume
+                return source
+            if volume == self.player.volume:
+                logger.debug(f"Using primed source for: {track.title}")
+                return source
+        source.cleanup()
+        return None
+
+    async def refresh(self, track: Track):
+        """Point a track at its cached file, or re-resolve it if its stream URL is about to expire"""
+        if self.audio_cache is not None and track.id:
+            track.path = self.audio_cache.lookup(track.id)
+            if track.path:
+                return
+        if track.expires - STREAM_URL_MARGIN > time.time() or not track.id:
+            return
+        fresh = await self.resolver.resolve(track.watch_url, self.player.guild_id)
+        if fresh is not None:
+            # Lazily listed playlist entries get their format details here too
+            track.url, track.expires = fresh["url"], fresh["expires"]
+            track.acodec, track.abr = fresh.get("acodec"), fresh.get("abr")
+            track.duration = track.duration or fresh.get("duration")
+            logger.info(f"Refreshed stream URL for: {track.title}")
+
+    def close(self):
+        self._task.cancel()
+        if self._primed is not None:
+            self._primed[1].cleanup()
+            self._primed = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), PREFETCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Prefetch failed in guild {self.player.guild_id}: {e}")
+
+    async def _tick(self):
+        upcoming = self.player.upcoming(self.depth)
+        for track in upcoming:
+            await self.refresh(track)
+
+        if not upcoming:
+            return
+        nxt = upcoming[0]
+        if self._primed is not None and self._primed[0] is not nxt:
+            # Queue changed since priming (skip, clear, loop toggle)
+            self._primed[1].cleanup()
+            self._primed = None
+        remaining = self.player.remaining()
+        if self._primed is None and remaining is not None and remaining <= self.lead and not self.player.paused:
+            loop = asyncio.get_running_loop()
+            volume = self.player.volume
+            source = await loop.run_in_executor(None, self._make_source, nxt, volume)
+            current = self.player.upcoming(1)
+            if self._primed is None and current and current[0] is nxt:
+                self._primed = (nxt, source, volume)
+                logger.debug(f"Primed next track: {nxt.title}")
+            else:
+                source.cleanup()
+
+
+# ─── State Store ────────────────────────────────────────────────────────────────
+class StateStore:
+    """SQLite (WAL) copy of every guild's queue, settings and playback position.
+
+    Writes are batched behind the players: flush() snapshots the guilds
+    whose revision changed since the last flush (plus the position of
+    every playing guild) on the event loop and writes them in a single
+    transaction on a dedicated thread. Cluster workers share the file.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER,
+            text_channel_id INTEGER,
+            loop INTEGER NOT NULL DEFAULT 0,
+            volume REAL NOT NULL DEFAULT 1.0,
+            playing INTEGER NOT NULL DEFAULT 0,  -- track 0 is the current one
+            position REAL NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            guild_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            query TEXT,
+            video_id TEXT,
+            title TEXT NOT NULL,
+            duration REAL,
+            PRIMARY KEY (guild_id, idx)
+        );
+        CREATE TABLE IF NOT EXISTS notify_channels (
+            channel_id INTEGER PRIMARY KEY
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._db = sqlite3.connect(path, check_same_thread=False)  # only used from the executor thread after this
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(self.SCHEMA)
+        self._saved: dict[int, int] = {}  # guild id -> revision last written
+        self.channels: frozenset = frozenset()  # notification channels this process has written or restored
+
+    @staticmethod
+    def snapshot(player: GuildPlayer) -> tuple:
+        voice = player.voice.channel.id if player.voice is not None and player.voice.is_connected() else None
+        text = getattr(player.channel, "id", None)
+        tracks = player.tracks()
+        playing = player.current is not None
+        rows = [(player.guild_id, idx, t.query, t.id, t.title, t.duration) for idx, t in enumerate(tracks)]
+        return (player.guild_id, voice, text, int(player.loop), player.volume, int(playing),
+                player.position if playing else 0.0, time.time()), rows
+
+    async def flush(self, players: dict, channels: set):
+        changed, positions = [], []
+        now = time.time()
+        for guild_id, player in players.items():
+            if self._saved.get(guild_id) != player.revision:
+                changed.append(self.snapshot(player))
+                self._saved[guild_id] = player.revision
+            elif player.current is not None:
+                positions.append((player.position, now, guild_id))
+        # Channels are written as a diff so cluster workers don't drop each other's
+        channels = frozenset(channels)
+        added, removed = channels - self.channels, self.channels - channels
+        if not (changed or positions or added or removed):
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write, changed, positions, added, removed)
+            self.channels = channels
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save state to {self.path}: {e}")
+            for guild, _ in changed:
+                self._saved.pop(guild[0], None)  # retry on the next flush
+
+    def _write(self, changed: list, positions: list, added: frozenset, removed: frozenset):
+        with self._db:
+            for guild, tracks in changed:
+                self._db.execute("INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?, ?, ?, ?)", guild)
+                self._db.execute("DELETE FROM tracks WHERE guild_id = ?", (guild[0],))
+                self._db.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?)", tracks)
+            self._db.executemany("UPDATE guilds SET position = ?, updated_at = ? WHERE guild_id = ?", positions)
+            self._db.executemany("INSERT OR IGNORE INTO notify_channels VALUES (?)", [(c,) for c in added])
+            self._db.executemany("DELETE FROM notify_channels WHERE channel_id = ?", [(c,) for c in removed])
+
+    async def load(self) -> tuple:
+        """Return ({guild id: (guild row, [Track, ...])}, {notification channel id, ...})"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._read)
+
+    def _read(self) -> tuple:
+        guilds = {}
+        for row in self._db.execute("SELECT * FROM guilds"):
+            guilds[row[0]] = (row, [])
+        for guild_id, _, query, video_id, title, duration in self._db.execute(
+                "SELECT * FROM tracks ORDER BY guild_id, idx"):
+            if guild_id in guilds:
+                guilds[guild_id][1].append(Track(query, video_id, title, duration))
+        channels = {row[0] for row in self._db.execute("SELECT channel_id FROM notify_channels")}
+        return guilds, channels
 
-# ─── Configuration ────────────────────────────────────────────────────────────────
-load_dotenv()
-TOKEN = os.getenv("DISCORD_TOKEN")
-CURRENT_VERSION = "1.4.6"
-GITHUB_CHANGELOG_URL = "https://raw.githubusercontent.com/ghcr96/musicbot/main/CHANGELOG.md"
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
 
-if not TOKEN:
-    logger.error("DISCORD_TOKEN not found in environment variables.")
-    logger.error("Please create a .env file with your Discord bot token:")
-    logger.error("DISCORD_TOKEN=your_bot_token_here")
-    exit(1)
 
-YTDL_OPTIONS = {
-    "format": "bestaudio/best",
-    "noplaylist": True,
-    "default_search": "ytsearch",
-    "quiet": True,
-}
-FFMPEG_OPTIONS = {
-    "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-    "options": "-vn",
-}
+# ─── Admission Control ──────────────────────────────────────────────────────────
+class PlaybackScheduler:
+    """Global budget of concurrent playback sessions.
 
-# Explicit FFmpeg executable path
-FFMPEG_EXECUTABLE = "/usr/bin/ffmpeg"
+    A guild holds one slot from when it starts playing until it leaves
+    voice. Guilds over the budget wait in a FIFO queue (one entry per
+    guild) and are admitted in order as slots free up. While throttled,
+    e.g. over the memory limit, nobody new is admitted but running
+    sessions carry on.
+    """
 
-# Enable required intents for voice functionality
-intents = discord.Intents.default()
-intents.message_content = True
-intents.voice_states = True
-intents.guilds = True
+    def __init__(self, limit: int = SESSION_LIMIT):
+        self.limit = limit
+        self.active: set[int] = set()
+        self.waiting: OrderedDict = OrderedDict()  # guild id -> Future[bool]
+        self.throttled = False
+
+    def try_acquire(self, guild_id: int) -> bool:
+        """Take a slot now if the guild has one or one is free (and nobody is ahead in line)"""
+        if guild_id in self.active:
+            return True
+        if self.waiting or not self._has_room():
+            return False
+        self.active.add(guild_id)
+        return True
+
+    def wait(self, guild_id: int) -> asyncio.Future:
+        """Join the line; the future resolves True when admitted, False if cancelled"""
+        future = self.waiting.get(guild_id)
+        if future is None:
+            future = self.waiting[guild_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def acquire(self, guild_id: int) -> bool:
+        """Take a slot, waiting in line if necessary"""
+        return self.try_acquire(guild_id) or await asyncio.shield(self.wait(guild_id))
+
+    def position(self, guild_id: int) -> int:
+        """1-based place in line, or 0 when not waiting"""
+        for place, waiting_id in enumerate(self.waiting, 1):
+            if waiting_id == guild_id:
+                return place
+        return 0
+
+    def release(self, guild_id: int):
+        self.active.discard(guild_id)
+        self._admit()
+
+    def cancel(self, guild_id: int):
+        """Drop a guild from the line (e.g. on .stop while waiting)"""
+        future = self.waiting.pop(guild_id, None)
+        if future is not None and not future.done():
+            future.set_result(False)
+
+    def set_throttled(self, throttled: bool):
+        self.throttled = throttled
+        self._admit()
+
+    def _has_room(self) -> bool:
+        return not self.throttled and (self.limit <= 0 or len(self.active) < self.limit)
+
+    def _admit(self):
+        while self.waiting and self._has_room():
+            guild_id, future = self.waiting.popitem(last=False)
+            if not future.done():
+                self.active.add(guild_id)
+                future.set_result(True)
+
+
+class ProcessMonitor:
+    """CPU and RSS of this process and its FFmpeg children, read from /proc.
+
+    sample() returns None where /proc is unavailable (e.g. macOS).
+    """
+
+    def __init__(self):
+        self.available = os.path.exists("/proc/self/stat")
+        self.pid = os.getpid()
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if self.available else 4096
+        self.ticks = os.sysconf("SC_CLK_TCK") if self.available else 100
+        self._last_time: Optional[float] = None
+        self._last_ticks: dict[int, int] = {}
+        self.latest: Optional[dict] = None
+
+    def _stat(self, pid) -> Optional[tuple]:
+        """(command name, parent pid, cpu ticks, rss bytes) of a process"""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                name, rest = f.read().split("(", 1)[1].rsplit(")", 1)
+        except (OSError, IndexError, ValueError):
+            return None
+        fields = rest.split()
+        return name, int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21]) * self.page_size
+
+    def sample(self) -> Optional[dict]:
+        if not self.available:
+            return None
+        now = time.monotonic()
+        elapsed = now - self._last_time if self._last_time is not None else None
+        usage = {"bot": {"rss": 0, "cpu": 0.0, "count": 1}, "ffmpeg": {"rss": 0, "cpu": 0.0, "count": 0}}
+        ticks = {}
+        own = self._stat(self.pid)
+        if own is not None:
+            ticks[self.pid] = own[2]
+            usage["bot"]["rss"] = own[3]
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            stat = self._stat(entry)
+            if stat is None or stat[1] != self.pid or not stat[0].startswith("ffmpeg"):
+                continue
+            ticks[int(entry)] = stat[2]
+            usage["ffmpeg"]["rss"] += stat[3]
+            usage["ffmpeg"]["count"] += 1
+        if elapsed:
+            for pid, total in ticks.items():
+                delta = max(total - self._last_ticks.get(pid, 0), 0)
+                usage["bot" if pid == self.pid else "ffmpeg"]["cpu"] += 100 * delta / self.ticks / elapsed
+        self._last_time, self._last_ticks = now, ticks
+        self.latest = usage
+        return usage
+
+
+# ─── Presence ───────────────────────────────────────────────────────────────────
+class PresenceManager:
+    """Turns per-guild status requests into rate-limited bot presence updates.
+
+    Guilds only report what they are doing; one task waits for changes to
+    settle, picks a single status for the whole bot and sends it at most
+    once every PRESENCE_MIN_INTERVAL seconds. With one active guild its
+    track is shown; with several, "auto" shows a server count and
+    "rotate" cycles between the count and each guild's track.
+    """
+
+    def __init__(self, bot: commands.Bot, mode: str = PRESENCE_MODE):
+        self.bot = bot
+        self.mode = mode
+        self.statuses: dict[int, str] = {}
+        self.sent: Optional[str] = None
+        self.requests = 0
+        self.updates = 0
+        self._changed = asyncio.Event()
+        self._rotation = 0
+        self._last_sent = float("-inf")
+        self._task = asyncio.create_task(self._run())
+
+    def set(self, guild_id: int, text: str):
+        self.requests += 1
+        if self.statuses.get(guild_id) != text:
+            self.statuses[guild_id] = text
+            self._changed.set()
+
+    def clear(self, guild_id: int):
+        self.requests += 1
+        if self.statuses.pop(guild_id, None) is not None:
+            self._changed.set()
+
+    def refresh(self):
+        """Resend the current status, e.g. after reconnecting to the gateway"""
+        self.sent = None
+        self._changed.set()
+
+    def choose(self) -> str:
+        if self.mode == "static" or not self.statuses:
+            return PRESENCE_IDLE_TEXT
+        if len(self.statuses) == 1:
+            return next(iter(self.statuses.values()))
+        summary = f"music in {len(self.statuses)} servers"
+        if self.mode == "rotate":
+            options = [summary, *self.statuses.values()]
+            return options[self._rotation % len(options)]
+        return summary
+
+    def close(self):
+        self._task.cancel()
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            rotating = self.mode == "rotate" and len(self.statuses) > 1
+            try:
+                await asyncio.wait_for(self._changed.wait(), PRESENCE_ROTATE_INTERVAL if rotating else None)
+            except asyncio.TimeoutError:
+                self._rotation += 1
+            await asyncio.sleep(max(PRESENCE_DEBOUNCE, self._last_sent + PRESENCE_MIN_INTERVAL - time.monotonic()))
+            self._changed.clear()
+            text = self.choose()
+            if text == self.sent:
+                continue
+            try:
+                await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=text))
+            except Exception as e:
+                logger.warning(f"Presence update failed: {e}")
+                continue
+            self.sent = text
+            self._last_sent = time.monotonic()
+            self.updates += 1
+            logger.debug(f"Presence set to '{text}' ({self.requests} requests, {self.updates} updates)")
+
+
+# ─── Outbound Messages ──────────────────────────────────────────────────────────
+class ChannelOutbox:
+    """Messages and now-playing panels waiting to go out to one channel"""
+
+    __slots__ = ("channel", "lines", "panels", "sent_at", "task")
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.lines: deque = deque()
+        self.panels: dict[int, str] = {}  # guild id -> latest panel text
+        self.sent_at: deque = deque()  # monotonic times of recent requests, for pacing
+        self.task: Optional[asyncio.Task] = None
 
-ytdl = YoutubeDL(YTDL_OPTIONS)
+
+class MessagePipeline:
+    """Per-channel outbound queue for messages the bot sends on its own.
+
+    A channel's worker waits MESSAGE_COALESCE seconds for a burst to end,
+    merges the queued lines into as few messages as fit in Discord's limit
+    and keeps to MESSAGE_RATE requests per MESSAGE_RATE_WINDOW. Each guild
+    also has one now-playing panel that is edited in place; only the latest
+    panel text is kept, so rapid skips cost a single edit.
+    """
+
+    def __init__(self):
+        self.outboxes: dict[int, ChannelOutbox] = {}
+        self.panels: dict[int, tuple] = {}  # guild id -> (channel id, message)
+        self._closing: set[int] = set()  # guilds whose panel is forgotten after its final edit
+        self.queued = 0
+        self.sent = 0
+        self.edits = 0
+
+    def send(self, channel: discord.abc.Messageable, text: str):
+        """Queue a message for the channel"""
+        box = self._outbox(channel)
+        box.lines.append(text[:MESSAGE_LIMIT])
+        self.queued += 1
+        self._wake(box)
+
+    def now_playing(self, guild_id: int, channel: discord.abc.Messageable, text: str, repost: bool = False):
+        """Show text in the guild's panel, editing the existing message when there is one.
+
+        repost sends a fresh panel at the bottom of the channel instead.
+        """
+        self._closing.discard(guild_id)
+        if repost:
+            self.panels.pop(guild_id, None)
+        box = self._outbox(channel)
+        box.panels[guild_id] = text[:MESSAGE_LIMIT]
+        self.queued += 1
+        self._wake(box)
+
+    def close_panel(self, guild_id: int, text: Optional[str] = None):
+        """Stop updating the guild's panel, optionally with a final edit"""
+        panel = self.panels.get(guild_id)
+        if panel is not None and text is not None:
+            box = self.outboxes.get(panel[0])
+            if box is not None:
+                box.panels[guild_id] = text
+                self._closing.add(guild_id)
+                self._wake(box)
+                return
+        self.panels.pop(guild_id, None)
+
+    def close(self):
+        for box in self.outboxes.values():
+            if box.task is not None:
+                box.task.cancel()
+
+    def _outbox(self, channel: discord.abc.Messageable) -> ChannelOutbox:
+        box = self.outboxes.get(channel.id)
+        if box is None:
+            box = self.outboxes[channel.id] = ChannelOutbox(channel)
+        return box
+
+    def _wake(self, box: ChannelOutbox):
+        # Workers exit once their outbox is empty and are restarted on demand
+        if box.task is None or box.task.done():
+            box.task = asyncio.create_task(self._run(box))
+
+    async def _run(self, box: ChannelOutbox):
+        while box.lines or box.panels:
+            await asyncio.sleep(MESSAGE_COALESCE)
+            try:
+                for chunk in self._merge(box.lines):
+                    await self._throttle(box)
+                    await box.channel.send(chunk)
+                    self.sent += 1
+                while box.panels:
+                    guild_id = next(iter(box.panels))
+                    await self._update_panel(box, guild_id, box.panels.pop(guild_id))
+            except discord.HTTPException as e:
+                logger.warning(f"Could not send to channel {box.channel.id}: {e}")
+
+    @staticmethod
+    def _merge(lines: deque) -> list:
+        """Pop all queued lines, packed into messages within MESSAGE_LIMIT"""
+        chunks, current = [], ""
+        while lines:
+            line = lines.popleft()
+            if current and len(current) + 1 + len(line) > MESSAGE_LIMIT:
+                chunks.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _throttle(self, box: ChannelOutbox):
+        now = time.monotonic()
+        while box.sent_at and now - box.sent_at[0] >= MESSAGE_RATE_WINDOW:
+            box.sent_at.popleft()
+        if len(box.sent_at) >= MESSAGE_RATE:
+            await asyncio.sleep(box.sent_at.popleft() + MESSAGE_RATE_WINDOW - now)
+        box.sent_at.append(time.monotonic())
+
+    async def _update_panel(self, box: ChannelOutbox, guild_id: int, text: str):
+        panel = self.panels.get(guild_id)
+        await self._throttle(box)
+        if panel is not None and panel[0] == box.channel.id:
+            try:
+                await panel[1].edit(content=text)
+                self.edits += 1
+            except discord.NotFound:
+                panel = None  # panel was deleted; post a new one
+        if panel is None or panel[0] != box.channel.id:
+            self.panels[guild_id] = (box.channel.id, await box.channel.send(text))
+            self.sent += 1
+        if guild_id in self._closing:
+            self._closing.discard(guild_id)
+            self.panels.pop(guild_id, None)
+
+
+# ─── Changelog ──────────────────────────────────────────────────────────────────
+def parse_latest_version(changelog_content: str) -> Optional[str]:
+    """Parse the latest version from changelog content"""
+    # Look for first version pattern like ## [1.3.0]
+    match = re.search(r'## \[([0-9]+\.[0-9]+\.[0-9]+)\]', changelog_content)
+    return match.group(1) if match else None
+
+
+def format_changelog(changelog_content: str, limit: int = 1900) -> str:
+    """Format the changelog markdown for Discord, cut to limit characters"""
+    formatted_lines = []
+    for line in changelog_content.split('\n')[2:]:  # Skip the main title
+        if line.startswith('## ['):
+            # Version headers
+            formatted_lines.append(f"**{line[3:].strip()}**")
+        elif line.startswith('### '):
+            # Section headers
+            formatted_lines.append(f"\n**{line[4:].strip()}**")
+        elif line.startswith('- **'):
+            # Feature items
+            formatted_lines.append(f"• {line[2:].strip()}")
+        elif line.strip() and not line.startswith('#'):
+            # Regular content
+            formatted_lines.append(line)
+
+    changelog_text = '\n'.join(formatted_lines)
+    if len(changelog_text) > limit:
+        changelog_text = changelog_text[:limit] + "\n\n*...view full changelog on GitHub*"
+    return changelog_text
+
+
+class ChangelogCache:
+    """Keeps the GitHub changelog, its latest version and the formatted text in memory.
+
+    A copy younger than CHANGELOG_TTL is served without a request. After
+    that GitHub is asked with If-None-Match/If-Modified-Since, so an
+    unchanged file costs a 304 and no reparse. Concurrent callers share
+    one request.
+    """
+
+    def __init__(self, bot, url: str = GITHUB_CHANGELOG_URL, ttl: float = CHANGELOG_TTL):
+        self.bot = bot
+        self.url = url
+        self.ttl = ttl
+        self.content: Optional[str] = None
+        self.latest_version: Optional[str] = None
+        self.formatted: Optional[str] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.checked_at = float("-inf")
+        self.fetches = 0
+        self.not_modified = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, force: bool = False) -> str:
+        """Return the changelog text, fetching it again only when stale (or forced)"""
+        async with self._lock:
+            if force or self.content is None or time.monotonic() - self.checked_at >= self.ttl:
+                await self._fetch()
+            return self.content
+
+    async def _fetch(self):
+        headers = {}
+        if self.content is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        async with self.bot.http_session.get(self.url, headers=headers) as response:
+            logger.info(f"GitHub changelog response: HTTP {response.status}")
+            if response.status == 304 and self.content is not None:
+                self.not_modified += 1
+            elif response.status == 200:
+                self.fetches += 1
+                self.content = await response.text()
+                self.latest_version = parse_latest_version(self.content)
+                self.formatted = format_changelog(self.content)
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+            else:
+                raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                  status=response.status)
+        self.checked_at = time.monotonic()
 
 
 # ─── Music Cog ──────────────────────────────────────────────────────────────────
@@ -63,37 +2338,257 @@ class Music(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.queues: dict[int, list[dict[str, str]]] = {}
-        self.loop_flags: dict[int, bool] = {}
+        self.players: dict[int, GuildPlayer] = {}
         self.update_check_channels: set[int] = set()  # Channels to notify about updates
+        self.search_results = LRUCache(1024, SEARCH_TTL)  # (guild id, user id) -> last .search candidates
+        self.loudness = LRUCache(CACHE_MAX_ENTRIES, 30 * 86400)  # video id -> normalization factor
+        self.resolver = Resolver()
+        self.presence = PresenceManager(bot)
+        self.outbox = MessagePipeline()
+        self.state = StateStore(STATE_DB) if STATE_DB else None
+        self._started = False
+        self.scheduler = PlaybackScheduler()
+        self.monitor = ProcessMonitor()
+        self.stream_recoveries = 0  # mid-track stream restarts
+        self.audio_cache = None
+        if AUDIO_CACHE_DIR:
+            # Cluster workers each keep their own cache so their indexes don't clash
+            worker_id = getattr(bot, "worker_id", None)
+            cache_dir = AUDIO_CACHE_DIR if worker_id is None else os.path.join(AUDIO_CACHE_DIR, f"worker-{worker_id}")
+            self.audio_cache = AudioCache(cache_dir, AUDIO_CACHE_MAX_MB * 1024 * 1024)
+        self.library = None
+        if LIBRARY_DIR:
+            try:
+                self.library = LocalLibrary(LIBRARY_DIR)
+            except sqlite3.Error as e:  # e.g. an SQLite build without FTS5 trigram support
+                logger.error(f"Local library disabled, could not open {LIBRARY_INDEX}: {e}")
         self.version_check_task.start()  # Start version checking task
+        self.reap_idle.start()
+        if self.audio_cache is not None:
+            self.audio_cache_flush.start()
+        # Cluster workers share the index; the first one keeps it up to date
+        if self.library is not None and getattr(bot, "worker_id", None) in (None, 0):
+            self.library_scan.start()
+        self._register_gauges()
 
-    async def update_status(self, activity_type, name):
-        """Update bot status dynamically."""
-        await self.bot.change_presence(
-            activity=discord.Activity(type=activity_type, name=name)
-        )
+    def _register_gauges(self):
+        metrics.gauge("meep_voice_connections", "Connected voice clients", lambda: len(self.bot.voice_clients))
+        metrics.gauge("meep_queue_depth", "Tracks queued or playing per guild", self.queue_depths, label="guild")
+        metrics.gauge("meep_resolve_cache_hits", "Resolve cache hits per layer",
+                      lambda: {name: layer["hits"] for name, layer in self.resolver.cache.stats().items()},
+                      label="cache")
+        metrics.gauge("meep_resolve_cache_misses", "Resolve cache misses per layer",
+                      lambda: {name: layer["misses"] for name, layer in self.resolver.cache.stats().items()},
+                      label="cache")
+        metrics.gauge("meep_audio_underruns", "Audio reads that found the read-ahead buffer empty",
+                      lambda: ReadAheadSource.total_underruns)
+        metrics.gauge("meep_sessions_active", "Guilds holding a playback session", lambda: len(self.scheduler.active))
+        metrics.gauge("meep_sessions_waiting", "Guilds waiting for a playback session",
+                      lambda: len(self.scheduler.waiting))
+        if self.monitor.available:
+            metrics.gauge("meep_process_rss_bytes", "Resident memory of the bot and its FFmpeg processes",
+                          lambda: {name: usage["rss"] for name, usage in (self.monitor.latest or {}).items()},
+                          label="process")
+            metrics.gauge("meep_process_cpu_percent", "CPU use of the bot and its FFmpeg processes",
+                          lambda: {name: round(usage["cpu"], 1) for name, usage in (self.monitor.latest or {}).items()},
+                          label="process")
+            metrics.gauge("meep_ffmpeg_processes", "Running FFmpeg processes",
+                          lambda: (self.monitor.latest or {}).get("ffmpeg", {}).get("count", 0))
+        metrics.gauge("meep_log_records_dropped", "Log records dropped because the writer fell behind",
+                      lambda: sum(getattr(h, "dropped", 0) for h in logging.getLogger().handlers))
+        metrics.gauge("meep_library_files", "Files in the local library index",
+                      lambda: self.library.files if self.library is not None else 0)
+        metrics.gauge("meep_library_lookups", "Play requests answered from the local library or passed on to YouTube",
+                      lambda: {"hit": self.library.hits, "miss": self.library.misses} if self.library is not None else {},
+                      label="result")
+        metrics.gauge("meep_stream_recoveries", "Tracks restarted after their stream failed mid-play",
+                      lambda: self.stream_recoveries)
+        metrics.gauge("meep_presence_updates", "Presence updates sent to Discord", lambda: self.presence.updates)
+        metrics.gauge("meep_resolve_coalesced", "Lookups served by another request's extraction",
+                      lambda: self.resolver.coalesced)
+        if self.audio_cache is not None:
+            metrics.gauge("meep_audio_cache_bytes", "Bytes used by the on-disk audio cache",
+                          lambda: self.audio_cache.size)
+
+    def queue_depths(self) -> dict:
+        return {guild_id: len(player) + (player.current is not None)
+                for guild_id, player in self.players.items() if player.current is not None or player.queue}
+
+    async def cog_unload(self):
+        self.version_check_task.cancel()
+        self.reap_idle.cancel()
+        self.presence.close()
+        self.outbox.close()
+        for player in self.players.values():
+            player.close_prefetcher()
+        self.resolver.close()
+        if self.audio_cache is not None:
+            self.audio_cache_flush.cancel()
+            self.audio_cache.close()
+        if self.library is not None:
+            self.library_scan.cancel()
+            self.library.close()
+        if self.state is not None:
+            self.state_flush.cancel()
+            await self.state.flush(self.players, self.update_check_channels)
+            self.state.close()
+
+    @tasks.loop(seconds=60)
+    async def audio_cache_flush(self):
+        """Persist audio cache play counts and last-use times"""
+        self.audio_cache.save()
+
+    @tasks.loop(minutes=LIBRARY_RESCAN_MINUTES or 60)
+    async def library_scan(self):
+        """Index new and changed files in the local library"""
+        try:
+            await self.library.scan()
+        except sqlite3.Error as e:
+            logger.error(f"Library scan failed: {e}")
+        if not LIBRARY_RESCAN_MINUTES:
+            self.library_scan.stop()  # scan at startup only
+
+    @tasks.loop(seconds=REAPER_INTERVAL)
+    async def reap_idle(self):
+        """Leave idle voice channels, free their sessions and apply the memory limit"""
+        usage = self.monitor.sample()
+        if usage is not None and MEMORY_LIMIT_MB:
+            rss_mb = (usage["bot"]["rss"] + usage["ffmpeg"]["rss"]) / 2 ** 20
+            if (rss_mb > MEMORY_LIMIT_MB) != self.scheduler.throttled:
+                if rss_mb > MEMORY_LIMIT_MB:
+                    logger.warning(f"Memory use {rss_mb:.0f} MB is over MEMORY_LIMIT_MB; pausing new sessions")
+                else:
+                    logger.info(f"Memory use back to {rss_mb:.0f} MB; admitting new sessions")
+                self.scheduler.set_throttled(rss_mb > MEMORY_LIMIT_MB)
+
+        now = time.monotonic()
+        for player in list(self.players.values()):
+            vc = player.voice
+            if vc is None or not vc.is_connected():
+                player.idle_since = None
+                if vc is not None and player.guild_id in self.scheduler.active:
+                    self.scheduler.release(player.guild_id)  # disconnected without going through _advance
+                continue
+            listeners = self._has_listeners(vc)
+            if vc.is_playing() and listeners:
+                player.idle_since = None
+                continue
+            if player.idle_since is None:
+                player.idle_since = now
+            elif now - player.idle_since >= (PAUSED_TIMEOUT if vc.is_paused() and listeners else IDLE_TIMEOUT):
+                await self._leave_idle(player)
+
+    @staticmethod
+    def _has_listeners(vc) -> bool:
+        members = getattr(vc.channel, "members", None)
+        return members is None or any(not member.bot for member in members)
+
+    async def _leave_idle(self, player: GuildPlayer):
+        vc = player.voice
+        logger.info(f"Leaving idle voice channel in guild {player.guild_id}")
+        player.reset()
+        await vc.disconnect()
+        self.scheduler.release(player.guild_id)
+        self.outbox.close_panel(player.guild_id, "💤 Left the voice channel after a period of inactivity.")
+        self.presence.clear(player.guild_id)
+
+    @tasks.loop(seconds=STATE_FLUSH_INTERVAL)
+    async def state_flush(self):
+        """Write changed queues and current positions to the state store"""
+        await self.state.flush(self.players, self.update_check_channels)
+
+    async def restore_state(self):
+        """Reload saved queues and resume guilds that were playing, seeking to where they were"""
+        guilds, channels = await self.state.load()
+        owned = {channel_id for channel_id in channels if self.bot.get_channel(channel_id) is not None}
+        self.update_check_channels |= owned
+        self.state.channels = frozenset(owned)
+        resumes = []
+        for guild_id, (row, tracks) in guilds.items():
+            if self.bot.get_guild(guild_id) is None:
+                continue  # not in this guild any more, or another shard/worker owns it
+            _, voice_id, text_id, loop, volume, playing, position, _ = row
+            player = self.get_player(guild_id)
+            player.loop, player.volume = bool(loop), volume
+            player.channel = self.bot.get_channel(text_id) if text_id else None
+            for track in tracks:
+                if track.id is None and self.library is not None and self.library.owns(track.query):
+                    track.path = track.query  # local library file
+                player.enqueue(track)
+            voice_channel = self.bot.get_channel(voice_id) if voice_id else None
+            if playing and voice_channel is not None:
+                resumes.append(self._resume(player, voice_channel, position))
+        if resumes:
+            logger.info(f"Resuming playback in {len(resumes)} guilds")
+            await asyncio.gather(*resumes)
+        logger.info(f"Restored state for {len(guilds)} guilds from {self.state.path}")
+
+    async def _resume(self, player: GuildPlayer, voice_channel, position: float):
+        if not self.scheduler.try_acquire(player.guild_id):
+            logger.info(f"No playback slot to resume guild {player.guild_id}; keeping its queue")
+            return
+        try:
+            player.voice = await voice_channel.connect(timeout=10.0, reconnect=True)
+            track = player.advance()
+            # Queued tracks keep their video IDs, so this resolves by ID without searching again
+            await self._play_current(player, start=position)
+        except Exception as e:
+            logger.error(f"Could not resume playback in guild {player.guild_id}: {e}")
+            if player.voice is None or not player.voice.is_connected():
+                player.voice = None
+                self.scheduler.release(player.guild_id)
+            return
+        logger.info(f"Resumed {track.title} at {format_duration(position)} in guild {player.guild_id}")
+        self.presence.set(player.guild_id, track.title)
+        self.refresh_panel(player, repost=True)
+
+    def get_player(self, guild_id: int) -> GuildPlayer:
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = GuildPlayer(guild_id)
+        return player
+
+    def panel_text(self, player: GuildPlayer) -> str:
+        track = player.current
+        if player.paused:
+            status = "⏸ Paused"
+        elif player.loop:
+            status = "🔁 Looping"
+        else:
+            status = "🎶 Now playing"
+        lines = [f"{status}: **{track.title}** `[{format_duration(track.duration)}]`"]
+        upcoming = player.page(0, 1)
+        if upcoming:
+            more = f" (+{len(player) - 1} more)" if len(player) > 1 else ""
+            lines.append(f"Up next: {upcoming[0].title}{more}")
+        return "\n".join(lines)
+
+    def refresh_panel(self, player: GuildPlayer, repost: bool = False):
+        """Update the guild's now-playing panel from the player state"""
+        if player.current is not None and player.channel is not None:
+            self.outbox.now_playing(player.guild_id, player.channel, self.panel_text(player), repost)
 
     @commands.Cog.listener()
     async def on_ready(self):
-        if not discord.opus.is_loaded():
-            try:
-                discord.opus.load_opus("/opt/homebrew/lib/libopus.0.dylib")
-                logger.info("Opus library loaded successfully.")
-            except OSError:
-                logger.warning("Opus library not found at macOS path; trying Linux path...")
-        if not discord.opus.is_loaded():
+        self.presence.refresh()
+        if self._started:
+            logger.info("Meep reconnected.")
+            return  # on_ready fires again after reconnects; startup work runs once
+        self._started = True
+        startup.mark("gateway")
+        if self.state is not None:
             try:
-                discord.opus.load_opus("/usr/lib/x86_64-linux-gnu/libopus.so.0")
-                logger.info("Opus library loaded successfully.")
-            except OSError:
-                logger.warning("Opus library not found; voice will be disabled.")
-
-        await self.update_status(discord.ActivityType.playing, ".help for commands")
-        logger.info("Meep is ready!")
-        
-        # Check for updates on startup
-        await self.check_for_updates()
+                await self.restore_state()
+            except sqlite3.Error as e:
+                logger.error(f"Could not restore state from {self.state.path}: {e}")
+            self.state_flush.start()  # only after restoring, so saved state isn't overwritten first
+            startup.mark("restore")
+        logger.info(f"Meep is ready! {startup.report()}")
+        # Off the critical path: get lookups ready for the first .play
+        # (the startup update check is the first run of version_check_task)
+        self.resolver.warm_up()
+        if PLAYBACK_MODE == "pcm":
+            await asyncio.get_running_loop().run_in_executor(None, load_numpy)
 
 
     @commands.Cog.listener()
@@ -105,15 +2600,28 @@ class Music(commands.Cog):
         else:
             await ctx.send(f"⚠️ Error: {error}")
 
-    @commands.command(help="Search YouTube and play the top result")
+    @commands.command(help="Play the best local library match or the top YouTube result, or queue a playlist URL")
     async def play(self, ctx, *, query: str):
+        requested_at = time.perf_counter()
         guild_id = ctx.guild.id
-        if guild_id not in self.queues:
-            self.queues[guild_id] = []
+        player = self.get_player(guild_id)
 
         if not ctx.author.voice:
             return await ctx.send("❌ You must join a voice channel first.")
 
+        # Admission control: wait for a free session slot before joining voice
+        if not self.scheduler.try_acquire(guild_id):
+            ticket = self.scheduler.wait(guild_id)
+            await ctx.send(f"⏳ Meep is playing in too many servers right now. You're "
+                           f"#{self.scheduler.position(guild_id)} in line; playback starts when a slot frees up.")
+            if not await asyncio.shield(ticket):
+                return
+            requested_at = time.perf_counter()
+            if not ctx.author.voice:
+                # Left voice while waiting in line; hand the slot to the next guild
+                self._release_unless_connected(ctx)
+                return await ctx.send("❌ You left the voice channel, so Meep didn't join.")
+
         # Connect or move
         channel = ctx.author.voice.channel
         try:
@@ -127,115 +2635,310 @@ class Music(commands.Cog):
                 logger.info(f"Successfully connected to voice channel: {channel.name}")
         except asyncio.TimeoutError:
             logger.error("Voice connection timed out")
+            self._release_unless_connected(ctx)
             return await ctx.send("❌ Connection to voice channel timed out. Please try again.")
         except discord.ClientException as e:
             logger.error(f"Discord client error during voice connection: {e}")
+            self._release_unless_connected(ctx)
             return await ctx.send(f"❌ Failed to connect to voice channel: {e}")
         except Exception as e:
             logger.error(f"Unexpected error during voice connection: {e}")
+            self._release_unless_connected(ctx)
             return await ctx.send(f"❌ Voice connection failed: {e}")
+        player.voice = vc
+        player.channel = ctx.channel
+        player.touch()
 
-        # Fetch info
-        try:
-            info = ytdl.extract_info(query, download=False)
-        except DownloadError as e:
-            return await ctx.send(f"❌ Could not fetch audio: {e}")
+        if is_playlist_url(query):
+            return await self._enqueue_playlist(ctx, player, query, requested_at)
+
+        # The local library answers without any network I/O; YouTube is the fallback
+        local = None
+        if self.library is not None and not query.startswith(("http://", "https://")):
+            try:
+                local = await self.library.match(query)
+            except sqlite3.Error as e:
+                logger.error(f"Library search failed: {e}")
+        if local is not None:
+            track = Track.from_library(local)
+        else:
+            # Fetch info off the event loop
+            try:
+                info = await self.resolver.resolve(query, guild_id)
+            except download_errors() as e:
+                return await ctx.send(f"❌ Could not fetch audio: {e}")
+            except asyncio.TimeoutError:
+                return await ctx.send("❌ Timed out looking up that track. Please try again.")
 
-        if "entries" in info:
-            info = info["entries"][0]
+            if info is None:
+                return await ctx.send("❌ No playable audio format found.")
 
-        # Pick best audio-only stream
-        formats = [f for f in info.get("formats", [])
-                   if f.get("acodec") != "none" and f.get("vcodec") == "none"]
-        if not formats:
-            return await ctx.send("❌ No playable audio format found.")
+            track = Track.from_resolved(query, info)
+        player.enqueue(track)
+        prefetcher = self.get_prefetcher(player)
 
-        best = max(formats, key=lambda f: f.get("abr") or 0)
-        url, title = best["url"], info.get("title", "Unknown")
+        if self._busy(player, vc):
+            prefetcher.poke()
+            await ctx.send(f"Queued **{track.title}**")
+            self.refresh_panel(player)
+        else:
+            try:
+                current = player.advance()
+                await self._play_current(player, requested_at)
+                self.presence.set(guild_id, current.title)
+                self.refresh_panel(player, repost=True)
+                logger.info(f"Started playing: {current.title}")
+            except Exception as e:
+                logger.error(f"Failed to start playback: {e}")
+                await ctx.send(f"❌ Failed to start playback: {e}")
 
-        # Enqueue or play  
-        self.queues[guild_id].append({"url": url, "title": title})
-        
-        # Create audio source with error handling
+    @commands.command(help="Search YouTube and list the top results to pick from")
+    async def search(self, ctx, *, query: str):
         try:
-            logger.info(f"Creating audio source for: {title}")
-            logger.debug(f"Stream URL: {url}")
-            source = PCMVolumeTransformer(discord.FFmpegPCMAudio(url, executable=FFMPEG_EXECUTABLE, **FFMPEG_OPTIONS))
-        except Exception as e:
-            logger.error(f"Failed to create audio source: {e}")
-            return await ctx.send(f"❌ Failed to create audio source: {e}")
+            results = await self.resolver.search(query, SEARCH_RESULTS, ctx.guild.id)
+        except download_errors() as e:
+            return await ctx.send(f"❌ Search failed: {e}")
+        except asyncio.TimeoutError:
+            return await ctx.send("❌ Timed out searching. Please try again.")
+        if not results:
+            return await ctx.send("❌ No results found.")
+        self.search_results.set((ctx.guild.id, ctx.author.id), results)
+        lines = [f"🔎 Results for **{query}**:"]
+        lines += [f"{i}. {entry['title']} `[{format_duration(entry['duration'])}]`"
+                  for i, entry in enumerate(results, 1)]
+        lines.append("Use `.pick <number>` to play one.")
+        await ctx.send("\n".join(lines)[:MESSAGE_LIMIT])
 
-        def _after(err):
-            if err:
-                logger.error(f"Audio playback error: {err}")
-                asyncio.run_coroutine_threadsafe(
-                    ctx.channel.send(f"❌ Audio playback error: {err}"),
-                    self.bot.loop
-                )
-                return
-                
-            queue = self.queues[guild_id]
-            if self.loop_flags.get(guild_id, False) and queue:
-                # replay same track
-                item = queue[0]
-                # Update status for looped song
-                asyncio.run_coroutine_threadsafe(
-                    self.update_status(discord.ActivityType.playing, f"🔁 {item['title']}"),
-                    self.bot.loop
-                )
-                # Send now playing message for looped song
-                asyncio.run_coroutine_threadsafe(
-                    ctx.channel.send(f"🔁 Looping: **{item['title']}**"),
-                    self.bot.loop
-                )
-            elif queue:
-                # dequeue next
-                item = queue.pop(0)
-                # Update status for next song
-                asyncio.run_coroutine_threadsafe(
-                    self.update_status(discord.ActivityType.playing, f"{item['title']}"),
-                    self.bot.loop
-                )
-                # Send now playing message for next song
-                asyncio.run_coroutine_threadsafe(
-                    ctx.channel.send(f"Now playing: **{item['title']}**"),
-                    self.bot.loop
-                )
-            else:
-                # Reset status when queue is empty
-                asyncio.run_coroutine_threadsafe(
-                    self.update_status(discord.ActivityType.playing, ".help for commands"),
-                    self.bot.loop
-                )
-                # Disconnect when queue is empty
-                asyncio.run_coroutine_threadsafe(
-                    vc.disconnect(),
-                    self.bot.loop
-                )
-                return
+    @commands.command(help="Play a result from your last .search")
+    async def pick(self, ctx, number: int):
+        results = self.search_results.get((ctx.guild.id, ctx.author.id))
+        if not results:
+            return await ctx.send("❌ No recent search. Use `.search <query>` first.")
+        if not 1 <= number <= len(results):
+            return await ctx.send(f"❌ Pick a number between 1 and {len(results)}.")
+        # Only the picked video is fully resolved, by URL so no search runs again
+        await ctx.invoke(self.play, query=f"https://www.youtube.com/watch?v={results[number - 1]['id']}")
+
+    def _release_unless_connected(self, ctx):
+        if ctx.voice_client is None or not ctx.voice_client.is_connected():
+            self.scheduler.release(ctx.guild.id)
+
+    async def _enqueue_playlist(self, ctx, player: GuildPlayer, url: str, requested_at: float):
+        """Queue playlist entries as they are listed, starting playback with the first one"""
+        await ctx.send("📃 Loading playlist...")
+        count = 0
+        try:
+            async for entry in self.resolver.iter_playlist(url):
+                if player.voice is None or not player.voice.is_connected():
+                    break  # stopped while loading
+                player.enqueue(Track(None, entry["id"], entry["title"], entry["duration"]))
+                count += 1
+                vc = player.voice
+                if self._busy(player, vc):
+                    if count <= PREFETCH_DEPTH:
+                        self.get_prefetcher(player).poke()
+                    continue
+                current = player.advance()
+                try:
+                    await self._play_current(player, requested_at)
+                    self.presence.set(player.guild_id, current.title)
+                    self.refresh_panel(player, repost=True)
+                    logger.info(f"Started playing: {current.title}")
+                except Exception as e:
+                    logger.error(f"Failed to start playlist entry {current.title}: {e}")
+                    await ctx.send(f"❌ Failed to play **{current.title}**: {e}")
+                    player.current = None
+        except download_errors() as e:
+            return await ctx.send(f"❌ Could not load playlist: {e}")
+        logger.info(f"Queued {count} tracks from playlist {url}")
+        await ctx.send(f"📃 Queued **{count}** tracks from the playlist.")
+        self.refresh_panel(player)
+
+    def make_source(self, track: Track, volume: float = 1.0, start: float = 0.0) -> discord.AudioSource:
+        """Spawn FFmpeg for a track, optionally starting start seconds in"""
+        logger.info(f"Creating audio source for: {track.title}")
+        if track.path:
+            # Local cached file: no reconnect handling needed
+            source, before_options = track.path, ""
+            logger.debug(f"Cached file: {track.path}")
+        else:
+            source, before_options = track.url, FFMPEG_OPTIONS["before_options"]
+            logger.debug(f"Stream URL: {track.url}")
+        if start > 0:
+            before_options += f" -ss {start:.2f}"
+
+        started = time.perf_counter()
+        if PLAYBACK_MODE == "opus":
             try:
-                new_src = PCMVolumeTransformer(discord.FFmpegPCMAudio(item["url"], executable=FFMPEG_EXECUTABLE, **FFMPEG_OPTIONS))
-                vc.play(new_src, after=lambda e: _after(e))
-                logger.info(f"Started playing next song: {item['title']}")
+                audio = self._make_opus_source(track, source, volume, before_options)
+                FFMPEG_SPAWN_SECONDS.observe(time.perf_counter() - started)
+                return MeteredReadAheadSource(audio) if AUDIO_READAHEAD_SECONDS > 0 else audio
             except Exception as e:
-                logger.error(f"Failed to create audio source for next song: {e}")
-                asyncio.run_coroutine_threadsafe(
-                    ctx.channel.send(f"❌ Failed to play next song: {e}"),
-                    self.bot.loop
-                )
+                logger.warning(f"Opus passthrough unavailable, falling back to PCM: {e}")
+        pcm = discord.FFmpegPCMAudio(source, executable=FFMPEG_EXECUTABLE, before_options=before_options,
+                                     options=FFMPEG_OPTIONS["options"])
+        FFMPEG_SPAWN_SECONDS.observe(time.perf_counter() - started)
+        if AUDIO_READAHEAD_SECONDS > 0:
+            pcm = ReadAheadSource(pcm)
+        if load_numpy() is not None:
+            # Only a play from the start measures the whole track
+            return MeteredDSPSource(pcm, volume, track.id or track.path, self.loudness, measure=not start)
+        return MeteredPCMSource(pcm, volume=volume)
 
-        if vc.is_playing():
-            await ctx.send(f"Queued **{title}**")
+    def _make_opus_source(self, track: Track, source: str, volume: float,
+                          before_options: str) -> MeteredOpusSource:
+        """Build a source that sends Opus packets without decoding them in Python.
+
+        Opus input at full volume is stream-copied; otherwise FFmpeg applies
+        the volume filter and encodes Opus itself, so discord.py never has to.
+        """
+        options = FFMPEG_OPTIONS["options"]
+        # FFmpegOpusAudio stream-copies when told the input is "opus" (or "libopus"/"copy")
+        # and encodes with libopus for any other value, including None
+        # Audio cache files are always Opus; library files say what they hold in acodec
+        if ((track.path and track.id) or track.acodec == "opus") and volume == 1.0:
+            codec = "opus"
         else:
+            codec = None
+            options += f" -filter:a volume={volume:.2f}"
+        bitrate = min(int(track.abr or OPUS_BITRATE), OPUS_BITRATE)
+        logger.debug(f"Opus source for {track.title}: {'copy' if codec else 'encode'}, bitrate={bitrate}k")
+        return MeteredOpusSource(source, bitrate=bitrate, codec=codec, executable=FFMPEG_EXECUTABLE,
+                                 before_options=before_options, options=options)
+
+    def get_prefetcher(self, player: GuildPlayer) -> Prefetcher:
+        if player.prefetcher is None:
+            player.prefetcher = Prefetcher(self.resolver, player, self.make_source, self.audio_cache)
+        return player.prefetcher
+
+    async def _play_current(self, player: GuildPlayer, requested_at: Optional[float] = None, start: float = 0.0):
+        """Start playing the player's current track, start seconds in.
+
+        requested_at is the perf_counter time of the .play command that
+        started it, used to measure time to first audio.
+        """
+        track = player.current
+        prefetcher = self.get_prefetcher(player)
+        player.starting = True  # the voice client stays idle until play(); .play must queue meanwhile
+        try:
+            source = prefetcher.take(track) if not start else None
+            if source is None:
+                await prefetcher.refresh(track)
+                if not (track.path or track.url):
+                    raise RuntimeError(f"no playable stream for {track.title}")
+                source = self.make_source(track, player.volume, start)
+            if requested_at is not None and isinstance(source, FirstFrameMixin):
+                source.on_first_frame = lambda: PLAY_TO_FIRST_FRAME_SECONDS.observe(time.perf_counter() - requested_at)
+
+            # The generation track_started() creates below; it only runs once play()
+            # succeeds, so a failed start can't orphan the callback of a track that plays
+            generation = player.generation + 1
+
+            def _after(err):
+                # Runs on the audio thread; hand the transition back to the event loop
+                asyncio.run_coroutine_threadsafe(self._advance(player, generation, err), self.bot.loop)
+
             try:
-                vc.play(source, after=lambda e: _after(e))
-                # Update status for first song
-                await self.update_status(discord.ActivityType.playing, f"{title}")
-                await ctx.send(f"Now playing **{title}**")
-                logger.info(f"Started playing: {title}")
-            except Exception as e:
-                logger.error(f"Failed to start playback: {e}")
-                await ctx.send(f"❌ Failed to start playback: {e}")
+                if player.voice is None:
+                    raise discord.ClientException("Not connected to voice.")  # stopped during the lookup
+                player.voice.play(source, after=_after)
+            except Exception:
+                source.cleanup()  # don't leak the FFmpeg process and read-ahead thread
+                raise
+            player.track_started(start)
+        finally:
+            player.starting = False
+        prefetcher.poke()
+        if self.audio_cache is not None:
+            self.audio_cache.record_play(track)
+
+    async def _advance(self, player: GuildPlayer, generation: int, err):
+        """Move to the next track once the current one has finished"""
+        if generation != player.generation:
+            return  # a newer track already took over
+        vc, channel = player.voice, player.channel
+
+        if vc is None or not vc.is_connected():
+            player.reset()
+            self.scheduler.release(player.guild_id)
+            self.outbox.close_panel(player.guild_id)
+            self.presence.clear(player.guild_id)
+            return
+        if err:
+            logger.error(f"Audio playback error: {err}")
+        if (err or self._ended_early(player)) and not player.skip_requested:
+            if await self._recover(player):
+                return
+            if err:
+                # Out of retries: move on instead of stopping the whole queue
+                self.outbox.send(channel, f"❌ Audio playback error on **{player.current.title}**: {err}")
+                player.skip_requested = True
+
+        looping = player.loop and not player.skip_requested
+        track = player.advance()
+        if track is None:
+            player.close_prefetcher()
+            self.outbox.close_panel(player.guild_id, "⏹ Queue finished.")
+            self.presence.clear(player.guild_id)
+            # Disconnect when queue is empty
+            player.voice = None
+            await vc.disconnect()
+            self.scheduler.release(player.guild_id)
+            return
+        self.presence.set(player.guild_id, f"🔁 {track.title}" if looping else track.title)
+        self.refresh_panel(player)
+        try:
+            await self._play_current(player)
+            logger.info(f"Started playing next song: {track.title}")
+        except Exception as e:
+            logger.error(f"Failed to create audio source for next song: {e}")
+            self.outbox.send(channel, f"❌ Failed to play next song: {e}")
+            if vc.is_connected() and not vc.is_playing():
+                # Skip the unplayable track (e.g. a removed playlist video)
+                player.skip_requested = True
+                await self._advance(player, player.generation, None)
+
+    @staticmethod
+    def _busy(player: GuildPlayer, vc) -> bool:
+        """True while a track is playing, paused, or being started or restarted"""
+        return vc.is_playing() or vc.is_paused() or player.recovering or player.starting
+
+    @staticmethod
+    def _ended_early(player: GuildPlayer) -> bool:
+        """True when the current track stopped well short of its known duration"""
+        track = player.current
+        return (track is not None and bool(track.duration)
+                and player.position < track.duration - STREAM_END_TOLERANCE)
+
+    async def _recover(self, player: GuildPlayer) -> bool:
+        """Re-resolve the current track and restart it where it stopped, within the retry budget"""
+        track, position = player.current, player.position
+        if track is None or player.recoveries >= STREAM_RETRY_LIMIT:
+            return False
+        player.recoveries += 1
+        self.stream_recoveries += 1
+        logger.warning(f"Stream for {track.title} stopped at {format_duration(position)}; "
+                       f"restarting (attempt {player.recoveries}/{STREAM_RETRY_LIMIT})")
+        generation = player.generation
+        player.recovering = True
+        try:
+            await asyncio.sleep(STREAM_RETRY_DELAY * 2 ** (player.recoveries - 1))
+            if (generation != player.generation or player.current is not track
+                    or player.voice is None or not player.voice.is_connected()):
+                return True  # skipped, stopped or restarted while we waited
+            # The old URL may be dead before its expire= time, so force a fresh lookup
+            if track.id:
+                self.resolver.cache.invalidate_stream(track.id)
+            if not track.path:
+                track.url, track.expires = None, 0.0
+            await self._play_current(player, start=position)
+        except Exception as e:
+            logger.error(f"Could not restart {track.title}: {e}")
+            return False
+        finally:
+            player.recovering = False
+        logger.info(f"Resumed {track.title} at {format_duration(position)}")
+        return True
 
     @commands.command(help="Skip the current track")
     async def skip(self, ctx):
@@ -243,11 +2946,8 @@ class Music(commands.Cog):
         if not vc or not vc.is_playing():
             return await ctx.send("❌ Nothing playing.")
         
-        # Remove the current song from queue when skipping
-        guild_id = ctx.guild.id
-        if guild_id in self.queues and self.queues[guild_id]:
-            self.queues[guild_id].pop(0)
-        
+        # Stopping triggers _advance; make sure it moves on even when loop is enabled
+        self.get_player(ctx.guild.id).skip_requested = True
         vc.stop()
         await ctx.send("⏭ Skipped.")
 
@@ -255,10 +2955,15 @@ class Music(commands.Cog):
     async def stop(self, ctx):
         vc = ctx.voice_client
         if vc:
+            self.get_player(ctx.guild.id).reset()
             await vc.disconnect()
-            # Reset status to default
-            await self.update_status(discord.ActivityType.playing, "Meep ready! .help for commands")
+            self.scheduler.release(ctx.guild.id)
+            self.outbox.close_panel(ctx.guild.id, "⏹ Stopped.")
+            self.presence.clear(ctx.guild.id)
             await ctx.send("⏹ Stopped and disconnected.")
+        elif self.scheduler.position(ctx.guild.id):
+            self.scheduler.cancel(ctx.guild.id)
+            await ctx.send("⏹ Left the line for a playback slot.")
         else:
             await ctx.send("❌ Not in a voice channel.")
 
@@ -267,8 +2972,10 @@ class Music(commands.Cog):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            # Update status to show paused
-            await self.update_status(discord.ActivityType.playing, "⏸ Paused")
+            player = self.get_player(ctx.guild.id)
+            player.pause()
+            self.presence.set(ctx.guild.id, "⏸ Paused")
+            self.refresh_panel(player)
             await ctx.send("⏸ Paused.")
         else:
             await ctx.send("❌ Nothing to pause.")
@@ -278,11 +2985,12 @@ class Music(commands.Cog):
         vc = ctx.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            # Get current song title for status
-            current_title = "Unknown"
-            if ctx.guild.id in self.queues and self.queues[ctx.guild.id]:
-                current_title = self.queues[ctx.guild.id][0]['title']
-            await self.update_status(discord.ActivityType.playing, f"{current_title}")
+            player = self.get_player(ctx.guild.id)
+            player.resume()
+            if player.prefetcher:
+                player.prefetcher.poke()
+            self.presence.set(ctx.guild.id, player.current.title if player.current else "Unknown")
+            self.refresh_panel(player)
             await ctx.send("▶️ Resumed.")
         else:
             await ctx.send("❌ Nothing to resume.")
@@ -293,43 +3001,146 @@ class Music(commands.Cog):
         if not vc or not getattr(vc, "source", None):
             return await ctx.send("❌ Nothing playing.")
         if 0 <= vol <= 100:
-            vc.source.volume = vol / 100
+            player = self.get_player(ctx.guild.id)
+            player.volume = vol / 100
+            player.touch()
+            if isinstance(vc.source, VOLUME_SOURCES):
+                vc.source.volume = vol / 100
+            elif player.current is not None:
+                # FFmpeg applies the volume in Opus mode; restart it where we are
+                old, position, paused = vc.source, player.position, vc.is_paused()
+                vc.source = self.make_source(player.current, player.volume, position)
+                if paused:
+                    vc.pause()  # swapping the source resumes playback
+                player.seeked(position)
+                old.cleanup()
             await ctx.send(f"🔊 Volume set to {vol}%")
         else:
             await ctx.send("❌ Volume must be between 0 and 100.")
 
-    @commands.command(help="Show queue")
-    async def queue(self, ctx):
-        q = self.queues.get(ctx.guild.id, [])
-        if not q:
+    @commands.command(help="Show the queue, one page at a time")
+    async def queue(self, ctx, page: int = 1):
+        player = self.get_player(ctx.guild.id)
+        if player.current is None and not player.queue:
             return await ctx.send("❌ Queue is empty.")
-        lines = [f"{i+1}. {item['title']}" for i, item in enumerate(q)]
-        await ctx.send("📜 Queue:\n" + "\n".join(lines))
+        pages = max((len(player) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE, 1)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        lines = [f"📜 Queue — {len(player)} tracks, page {page}/{pages}"]
+        if player.current is not None and page == 1:
+            lines.append(f"▶️ {player.current.title} `[{format_duration(player.current.duration)}]`")
+        # Titles are clipped so a full page always fits in one message
+        width = (MESSAGE_LIMIT - 200) // QUEUE_PAGE_SIZE - 20
+        for i, track in enumerate(player.page(start, QUEUE_PAGE_SIZE), start + 1):
+            title = track.title if len(track.title) <= width else track.title[:width - 1] + "…"
+            lines.append(f"{i}. {title} `[{format_duration(track.duration)}]`")
+        if page < pages:
+            lines.append(f"Use `.queue {page + 1}` for the next page.")
+        await ctx.send("\n".join(lines))
 
     @commands.command(help="Clear the queue")
     async def clear(self, ctx):
-        self.queues[ctx.guild.id] = []
+        player = self.get_player(ctx.guild.id)
+        player.clear()
+        self.refresh_panel(player)
         await ctx.send("🧹 Queue cleared.")
 
+    @commands.command(help="Remove a track from the queue")
+    async def remove(self, ctx, position: int):
+        player = self.get_player(ctx.guild.id)
+        if not 1 <= position <= len(player):
+            return await ctx.send(f"❌ Position must be between 1 and {len(player)}.")
+        track = player.remove(position - 1)
+        self.refresh_panel(player)
+        await ctx.send(f"🗑 Removed **{track.title}**")
+
+    @commands.command(help="Move a track to another queue position")
+    async def move(self, ctx, src: int, dst: int):
+        player = self.get_player(ctx.guild.id)
+        if not (1 <= src <= len(player) and 1 <= dst <= len(player)):
+            return await ctx.send(f"❌ Positions must be between 1 and {len(player)}.")
+        track = player.move(src - 1, dst - 1)
+        self.refresh_panel(player)
+        await ctx.send(f"↕️ Moved **{track.title}** to position {dst}")
+
+    @commands.command(help="Shuffle the queue")
+    async def shuffle(self, ctx):
+        player = self.get_player(ctx.guild.id)
+        if not player.queue:
+            return await ctx.send("❌ Queue is empty.")
+        player.shuffle()
+        self.refresh_panel(player)
+        await ctx.send("🔀 Queue shuffled.")
+
     @commands.command(help="Enable loop")
     async def loop(self, ctx):
-        self.loop_flags[ctx.guild.id] = True
+        player = self.get_player(ctx.guild.id)
+        player.loop = True
+        player.touch()
+        self.refresh_panel(player)
         await ctx.send("🔁 Loop enabled.")
 
     @commands.command(help="Disable loop")
     async def unloop(self, ctx):
-        self.loop_flags[ctx.guild.id] = False
+        player = self.get_player(ctx.guild.id)
+        player.loop = False
+        player.touch()
+        self.refresh_panel(player)
         await ctx.send("🔁 Loop disabled.")
 
     @commands.command(help="Show current track")
     async def nowplaying(self, ctx):
         vc = ctx.voice_client
-        q = self.queues.get(ctx.guild.id, [])
-        if vc and vc.is_playing() and q:
-            await ctx.send(f"Now playing: **{q[0]['title']}**")
+        player = self.get_player(ctx.guild.id)
+        if vc and (vc.is_playing() or vc.is_paused()) and player.current:
+            player.channel = ctx.channel
+            self.refresh_panel(player, repost=True)
         else:
             await ctx.send("❌ Nothing playing.")
     
+    @commands.command(help="Show performance statistics (admins only)")
+    @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+    async def stats(self, ctx):
+        def ms(histogram: Histogram, p: float) -> str:
+            value = histogram.percentile(p)
+            return "n/a" if value is None else f"{value * 1000:.0f}ms"
+
+        cache = self.resolver.cache.stats()["queries"]
+        lookups = cache["hits"] + cache["misses"]
+        hit_rate = f"{100 * cache['hits'] / lookups:.0f}%" if lookups else "n/a"
+        depths = self.queue_depths()
+        await ctx.send(
+            f"📊 **Meep Stats**\n"
+            f"Servers: **{len(self.bot.guilds)}** • Voice connections: **{len(self.bot.voice_clients)}** • "
+            f"Queued tracks: **{sum(depths.values())}** (deepest {max(depths.values(), default=0)})\n"
+            f"Lookup time: p50 {ms(RESOLVE_SECONDS, 50)} • p95 {ms(RESOLVE_SECONDS, 95)}\n"
+            f"`.play` to first audio: p50 {ms(PLAY_TO_FIRST_FRAME_SECONDS, 50)} • "
+            f"p95 {ms(PLAY_TO_FIRST_FRAME_SECONDS, 95)}\n"
+            f"FFmpeg start: p50 {ms(FFMPEG_SPAWN_SECONDS, 50)} • p95 {ms(FFMPEG_SPAWN_SECONDS, 95)}\n"
+            f"Event-loop lag: p95 {ms(LOOP_LAG_SECONDS, 95)} • p99 {ms(LOOP_LAG_SECONDS, 99)}\n"
+            f"Audio buffer underruns: {ReadAheadSource.total_underruns}\n"
+            f"Sessions: {len(self.scheduler.active)}/{self.scheduler.limit or '∞'} "
+            f"({len(self.scheduler.waiting)} waiting{', throttled' if self.scheduler.throttled else ''})\n"
+            f"{self._usage_line()}\n"
+            f"Lookup cache hit rate: {hit_rate} • Coalesced lookups: {self.resolver.coalesced}"
+            f"{self._library_line()}"
+        )
+
+    def _library_line(self) -> str:
+        library = self.library
+        if library is None:
+            return ""
+        return (f"\nLocal library: {library.files} files{' (scanning)' if library.scanning else ''} • "
+                f"{library.hits} plays found locally, {library.misses} sent to YouTube")
+
+    def _usage_line(self) -> str:
+        usage = self.monitor.latest
+        if usage is None:
+            return "Process usage: n/a"
+        bot, ffmpeg = usage["bot"], usage["ffmpeg"]
+        return (f"Bot: {bot['rss'] / 2 ** 20:.0f} MB, {bot['cpu']:.0f}% CPU • "
+                f"FFmpeg ×{ffmpeg['count']}: {ffmpeg['rss'] / 2 ** 20:.0f} MB, {ffmpeg['cpu']:.0f}% CPU")
+
     @tasks.loop(hours=6)  # Check for updates every 6 hours
     async def version_check_task(self):
         """Periodic version check task - only notifies if out of date"""
@@ -343,33 +3154,22 @@ class Music(commands.Cog):
     async def check_for_updates(self):
         """Check GitHub for newer version and notify only if out of date"""
         logger.info("Checking GitHub for version updates...")
+        changelog = self.bot.changelog
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(GITHUB_CHANGELOG_URL) as response:
-                    logger.info(f"GitHub version check response: HTTP {response.status}")
-                    if response.status == 200:
-                        changelog_content = await response.text()
-                        latest_version = self.parse_latest_version(changelog_content)
-                        
-                        if latest_version:
-                            logger.info(f"Parsed latest version from GitHub: {latest_version} (current: {CURRENT_VERSION})")
-                            if self.is_newer_version(latest_version, CURRENT_VERSION):
-                                logger.info(f"New version {latest_version} available - sending notifications")
-                                await self.notify_update_available(latest_version)
-                            else:
-                                logger.info("Meep is up to date")
-                        else:
-                            logger.warning("Could not parse version from GitHub changelog")
-                    else:
-                        logger.warning(f"Could not check for updates: HTTP {response.status}")
+            await changelog.get(force=True)
         except Exception as e:
             logger.error(f"Error checking for updates: {e}")
-    
-    def parse_latest_version(self, changelog_content: str) -> str:
-        """Parse the latest version from changelog content"""
-        # Look for first version pattern like ## [1.3.0]
-        match = re.search(r'## \[([0-9]+\.[0-9]+\.[0-9]+)\]', changelog_content)
-        return match.group(1) if match else None
+            return
+        latest_version = changelog.latest_version
+        if latest_version:
+            logger.info(f"Latest version on GitHub: {latest_version} (current: {CURRENT_VERSION})")
+            if self.is_newer_version(latest_version, CURRENT_VERSION):
+                logger.info(f"New version {latest_version} available - sending notifications")
+                await self.notify_update_available(latest_version)
+            else:
+                logger.info("Meep is up to date")
+        else:
+            logger.warning("Could not parse version from GitHub changelog")
     
     def is_newer_version(self, latest: str, current: str) -> bool:
         """Compare version strings (semantic versioning)"""
@@ -391,17 +3191,17 @@ class Music(commands.Cog):
             return
         
         logger.info(f"Sending update notifications to {len(self.update_check_channels)} channels")
-        update_message = f"🔄 **Meep Update Available!**\\n\\n" \
-                        f"Current version: **{CURRENT_VERSION}**\\n" \
-                        f"Latest version: **{latest_version}**\\n\\n" \
+        update_message = f"🔄 **Meep Update Available!**\n\n" \
+                        f"Current version: **{CURRENT_VERSION}**\n" \
+                        f"Latest version: **{latest_version}**\n\n" \
                         f"Use `.update` to update Meep to the latest version."
         
         for channel_id in self.update_check_channels.copy():
             try:
                 channel = self.bot.get_channel(channel_id)
                 if channel:
-                    await channel.send(update_message)
-                    logger.info(f"Update notification sent to channel {channel_id} ({channel.name})")
+                    self.outbox.send(channel, update_message)
+                    logger.info(f"Update notification queued for channel {channel_id} ({channel.name})")
                 else:
                     logger.warning(f"Could not find channel {channel_id}, removing from notifications")
                     self.update_check_channels.discard(channel_id)
@@ -429,47 +3229,48 @@ class Music(commands.Cog):
         await ctx.send("🔍 Checking for updates...")
         logger.info(f"Manual update check requested by {ctx.author} in {ctx.channel}")
         
+        changelog = self.bot.changelog
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(GITHUB_CHANGELOG_URL) as response:
-                    logger.info(f"Manual GitHub version check response: HTTP {response.status}")
-                    if response.status == 200:
-                        changelog_content = await response.text()
-                        latest_version = self.parse_latest_version(changelog_content)
-                        
-                        if latest_version:
-                            logger.info(f"Manual check - parsed version: {latest_version} (current: {CURRENT_VERSION})")
-                            if self.is_newer_version(latest_version, CURRENT_VERSION):
-                                await ctx.send(f"🔄 **Update Available!**\\n\\n" \
-                                             f"Current: **{CURRENT_VERSION}**\\n" \
-                                             f"Latest: **{latest_version}**\\n\\n" \
-                                             f"Use `.update` to update Meep.")
-                            else:
-                                await ctx.send(f"✅ **Meep is up to date!**\\n\\n" \
-                                             f"Current version: **{CURRENT_VERSION}**")
-                        else:
-                            logger.warning("Manual check - could not parse version from changelog")
-                            await ctx.send("❌ Could not parse version from changelog.")
-                    else:
-                        await ctx.send(f"❌ Could not check for updates: HTTP {response.status}")
+            await changelog.get()
+        except aiohttp.ClientResponseError as e:
+            return await ctx.send(f"❌ Could not check for updates: HTTP {e.status}")
         except Exception as e:
             logger.error(f"Error in manual update check: {e}")
-            await ctx.send("❌ Error checking for updates. Please try again later.")
+            return await ctx.send("❌ Error checking for updates. Please try again later.")
+
+        latest_version = changelog.latest_version
+        if not latest_version:
+            logger.warning("Manual check - could not parse version from changelog")
+            return await ctx.send("❌ Could not parse version from changelog.")
+        logger.info(f"Manual check - latest version: {latest_version} (current: {CURRENT_VERSION})")
+        if self.is_newer_version(latest_version, CURRENT_VERSION):
+            await ctx.send(f"🔄 **Update Available!**\n\n"
+                           f"Current: **{CURRENT_VERSION}**\n"
+                           f"Latest: **{latest_version}**\n\n"
+                           f"Use `.update` to update Meep.")
+        else:
+            await ctx.send(f"✅ **Meep is up to date!**\n\n"
+                           f"Current version: **{CURRENT_VERSION}**")
     @commands.command(help="Provides a list of commands")
     async def help(self, ctx):
         help_text = """**Meep Commands**
 
 **Playback:**
-• `.play <query>` - Search YouTube and play the top result
+• `.play <query>` - Play the best match from the local library, else the top YouTube result (or queue a playlist URL)
+• `.search <query>` - List the top YouTube results
+• `.pick <number>` - Play a result from your last search
 • `.skip` - Skip the current track
 • `.stop` - Stop and leave voice channel
 • `.pause` - Pause playback
 • `.resume` - Resume playback
 
 **Queue Management:**
-• `.queue` - Show current queue
+• `.queue [page]` - Show the queue, 10 tracks per page
 • `.clear` - Clear the queue
-• `.nowplaying` - Show current track
+• `.remove <position>` - Remove a track from the queue
+• `.move <from> <to>` - Move a track within the queue
+• `.shuffle` - Shuffle the queue
+• `.nowplaying` - Show the now-playing panel (moves it to the bottom of the chat)
 
 **Settings:**
 • `.volume <0-100>` - Set volume
@@ -478,6 +3279,7 @@ class Music(commands.Cog):
 
 **Utility:**
 • `.ping` - Check bot responsiveness
+• `.stats` - Show performance statistics (admins)
 • `.changelog` - Show bot version history
 • `.version` - Show bot's version"""
         
@@ -499,46 +3301,12 @@ class General(commands.Cog):
 
     @commands.command(help="Show bot changelog")
     async def changelog(self, ctx):
-        # GitHub raw URL for the CHANGELOG.md file
-        github_url = "https://raw.githubusercontent.com/YOUR_USERNAME/YOUR_REPO/main/CHANGELOG.md"
-        
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(github_url) as response:
-                    if response.status == 200:
-                        changelog_content = await response.text()
-                        
-                        # Format the markdown for Discord
-                        # Remove the main title and format for Discord display
-                        lines = changelog_content.split('\n')
-                        formatted_lines = []
-                        
-                        for line in lines[2:]:  # Skip the main title
-                            if line.startswith('## ['):
-                                # Version headers
-                                formatted_lines.append(f"**{line[3:].strip()}**")
-                            elif line.startswith('### '):
-                                # Section headers
-                                formatted_lines.append(f"\n**{line[4:].strip()}**")
-                            elif line.startswith('- **'):
-                                # Feature items
-                                formatted_lines.append(f"• {line[2:].strip()}")
-                            elif line.strip() and not line.startswith('#'):
-                                # Regular content
-                                formatted_lines.append(line)
-                        
-                        # Limit to first 1900 characters for Discord message limit
-                        changelog_text = '\n'.join(formatted_lines)[:1900]
-                        if len('\n'.join(formatted_lines)) > 1900:
-                            changelog_text += "\n\n*...view full changelog on GitHub*"
-                        
-                        await ctx.send(f"**Meep Changelog**\n\n{changelog_text}")
-                    else:
-                        raise aiohttp.ClientResponseError(None, None, status=response.status)
-                        
+            await self.bot.changelog.get()
         except Exception as e:
             logger.error(f"Error fetching changelog: {e}")
-            await ctx.send("❌ Could not fetch changelog from GitHub. Please try again later.")
+            return await ctx.send("❌ Could not fetch changelog from GitHub. Please try again later.")
+        await ctx.send(f"**Meep Changelog**\n\n{self.bot.changelog.formatted}")
             
     @commands.command(help="Show bot version")
     async def version(self, ctx):
@@ -549,32 +3317,303 @@ class General(commands.Cog):
         await ctx.send(version_text)
 
 
+# ─── Startup ────────────────────────────────────────────────────────────────────
+OPUS_LIBRARY = os.getenv("OPUS_LIBRARY", "")  # path to libopus, if it isn't found on its own
+OPUS_SEARCH_PATHS = (
+    "/opt/homebrew/lib/libopus.0.dylib",
+    "/usr/local/lib/libopus.0.dylib",
+    "/usr/lib/x86_64-linux-gnu/libopus.so.0",
+    "/usr/lib/aarch64-linux-gnu/libopus.so.0",
+)
+_opus_found: Optional[bool] = None
+
+
+def _opus_candidates():
+    """Likely libopus locations, cheapest to check first"""
+    if OPUS_LIBRARY:
+        yield OPUS_LIBRARY
+    yield from (path for path in OPUS_SEARCH_PATHS if os.path.exists(path))
+    # Slowest: may run ldconfig or a compiler to locate the library
+    path = ctypes.util.find_library("opus")
+    if path:
+        yield path
+
+
+def _try_load_opus(path: str) -> bool:
+    try:
+        discord.opus.load_opus(path)
+    except OSError:
+        return False
+    logger.info(f"Opus library loaded from {path}")
+    return True
+
+
+def load_opus() -> bool:
+    """Find and load libopus, searching only once per process"""
+    global _opus_found
+    if _opus_found is None:
+        _opus_found = discord.opus.is_loaded() or any(map(_try_load_opus, _opus_candidates()))
+        if not _opus_found:
+            logger.warning("Opus library not found; voice will be disabled.")
+    return _opus_found
+
+
+class StartupTimer:
+    """Records how long each startup phase took, for the ready log line"""
+
+    def __init__(self, began: float):
+        self.began = self.last = began
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        """End the current phase, naming it phase"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self) -> str:
+        breakdown = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases)
+        return f"Started in {self.last - self.began:.2f}s ({breakdown})"
+
+
+startup = StartupTimer(STARTUP_BEGAN)
+
+
 # ─── Bot Subclass ──────────────────────────────────────────────────────────────
-class MusicBot(commands.Bot):
-    def __init__(self):
+class MusicBot(commands.AutoShardedBot):
+    def __init__(self, shard_ids: Optional[list] = None, shard_count: Optional[int] = None,
+                 worker_id: Optional[int] = None, status_queue=None):
+        if shard_count is None and SHARD_COUNT != "auto":
+            shard_count = int(SHARD_COUNT or 1)
         super().__init__(
             command_prefix=".",
             intents=intents,
             help_command=None,
             status=discord.Status.online,
-            activity=discord.Activity(type=discord.ActivityType.listening, name="Meep starting...")
+            activity=discord.Activity(type=discord.ActivityType.listening, name="Meep starting..."),
+            shard_ids=shard_ids,
+            shard_count=shard_count,
         )
+        self.worker_id = worker_id
+        self.status_queue = status_queue  # reports to the cluster supervisor, if any
+        self.metrics_runner: Optional[web.AppRunner] = None
+        self._lag_watchdog: Optional[asyncio.Task] = None
+        self.http_session: Optional[aiohttp.ClientSession] = None  # shared by all outbound HTTP calls
+        self.changelog = ChangelogCache(self)
 
     async def setup_hook(self):
+        startup.mark("login")
+        load_opus()
+        self.http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300),
+        )
         await self.add_cog(Music(self))
         await self.add_cog(General(self))
+        if self.status_queue is not None:
+            self.report_status.start()
+        self._lag_watchdog = asyncio.create_task(self.watch_loop_lag())
+        if METRICS_PORT:
+            port = METRICS_PORT + (self.worker_id or 0)
+            try:
+                self.metrics_runner = await start_metrics_server(METRICS_HOST, port)
+            except OSError as e:
+                logger.error(f"Could not start metrics endpoint on port {port}: {e}")
+        startup.mark("setup")
+
+    async def close(self):
+        if self._lag_watchdog is not None:
+            self._lag_watchdog.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+        if self.http_session is not None:
+            await self.http_session.close()
+
+    async def watch_loop_lag(self):
+        """Measure how late the event loop runs a sleeping task"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0.0)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop lagged {lag * 1000:.0f}ms")
+
+    def status_snapshot(self) -> dict:
+        return {
+            "worker": self.worker_id,
+            "shards": sorted(self.shards),
+            "guilds": len(self.guilds),
+            "voice": len(self.voice_clients),
+            "latency_ms": round(self.latency * 1000) if self.is_ready() else None,
+            "time": time.time(),
+        }
+
+    @tasks.loop(seconds=CLUSTER_STATUS_INTERVAL)
+    async def report_status(self):
+        """Send this worker's status to the supervisor"""
+        try:
+            self.status_queue.put_nowait(self.status_snapshot())
+        except queue.Full:
+            pass
+
+
+# ─── Cluster Launcher ──────────────────────────────────────────────────────────
+def fetch_recommended_shards() -> int:
+    """Ask Discord how many shards this bot should run"""
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get("https://discord.com/api/v10/gateway/bot",
+                                   headers={"Authorization": f"Bot {TOKEN}"}) as response:
+                response.raise_for_status()
+                return (await response.json())["shards"]
+    return asyncio.run(fetch())
+
+
+def _run_worker(worker_id: int, shard_ids: list, shard_count: int, status_queue, log_queue):
+    """Entry point of a cluster worker process"""
+    global log_listener
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor handles Ctrl+C
+    # Send log records to the supervisor, which writes (and rotates) the one log file
+    log_listener.stop()
+    log_listener = setup_logging(log_queue)
+    logger.info(f"Worker {worker_id} starting shards {shard_ids} of {shard_count}")
+    bot = MusicBot(shard_ids=shard_ids, shard_count=shard_count, worker_id=worker_id, status_queue=status_queue)
+    bot.run(TOKEN, log_handler=None)  # discord.* records go through the queue too
+
+
+class ClusterSupervisor:
+    """Runs the bot's shards across several worker processes.
+
+    Shards are split round-robin between workers. Workers are started
+    IDENTIFY_DELAY seconds apart per shard to respect Discord's identify
+    rate limit. A worker that exits is restarted with exponential backoff.
+    Status reports from the workers are merged into one log summary.
+    """
+
+    def __init__(self, workers: int = CLUSTER_WORKERS, shard_count: Optional[int] = None):
+        if shard_count is None:
+            shard_count = fetch_recommended_shards() if SHARD_COUNT in ("", "auto") else int(SHARD_COUNT)
+        self.shard_count = max(shard_count, workers)
+        self.workers = workers
+        self.assignments = [list(range(i, self.shard_count, workers)) for i in range(workers)]
+        self.ctx = multiprocessing.get_context("spawn")
+        self.status_queue = self.ctx.Queue(maxsize=1000)
+        self.log_queue = self.ctx.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *log_listener.handlers)
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self.restarts: dict[int, int] = {i: 0 for i in range(workers)}
+        self.next_start: dict[int, float] = {}
+        self.status: dict[int, dict] = {}
+        self._stopping = False
+
+    def start_worker(self, worker_id: int):
+        proc = self.ctx.Process(
+            target=_run_worker, name=f"meep-worker-{worker_id}",
+            args=(worker_id, self.assignments[worker_id], self.shard_count, self.status_queue, self.log_queue),
+        )
+        proc.start()
+        self.processes[worker_id] = proc
+        logger.info(f"Started worker {worker_id} (pid {proc.pid}) with shards {self.assignments[worker_id]}")
+
+    def run(self):
+        logger.info(f"Starting cluster: {self.shard_count} shards across {self.workers} workers")
+        self.log_listener.start()
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        try:
+            for worker_id in range(self.workers):
+                self.start_worker(worker_id)
+                time.sleep(IDENTIFY_DELAY * len(self.assignments[worker_id]))
+            last_summary = time.time()
+            while not self._stopping:
+                self._drain_status()
+                self._check_workers()
+                if time.time() - last_summary >= CLUSTER_STATUS_INTERVAL:
+                    self.log_summary()
+                    last_summary = time.time()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("Cluster shutdown requested by user.")
+        finally:
+            self.stop()
+
+    def _drain_status(self):
+        while True:
+            try:
+                report = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.status[report["worker"]] = report
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id, proc in list(self.processes.items()):
+            if proc.is_alive():
+                continue
+            if worker_id not in self.next_start:
+                delay = min(2 ** self.restarts[worker_id] * IDENTIFY_DELAY, CLUSTER_RESTART_MAX_DELAY)
+                logger.error(f"Worker {worker_id} exited with code {proc.exitcode}; restarting in {delay}s")
+                self.status.pop(worker_id, None)
+                self.next_start[worker_id] = now + delay
+            elif now >= self.next_start[worker_id]:
+                del self.next_start[worker_id]
+                self.restarts[worker_id] += 1
+                self.start_worker(worker_id)
+
+    def aggregate(self) -> dict:
+        reports = list(self.status.values())
+        return {
+            "workers_alive": sum(proc.is_alive() for proc in self.processes.values()),
+            "workers": self.workers,
+            "shards": self.shard_count,
+            "guilds": sum(r["guilds"] for r in reports),
+            "voice": sum(r["voice"] for r in reports),
+            "restarts": sum(self.restarts.values()),
+        }
+
+    def log_summary(self):
+        summary = self.aggregate()
+        logger.info(
+            f"Cluster: {summary['workers_alive']}/{summary['workers']} workers, {summary['shards']} shards, "
+            f"{summary['guilds']} guilds, {summary['voice']} voice connections, {summary['restarts']} restarts"
+        )
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        for proc in self.processes.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.processes.values():
+            proc.join(timeout=10)
+        self.log_listener.stop()
+        logger.info("Cluster stopped.")
+
+
+startup.mark("imports")
 
 
 # ─── Entry Point ───────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    bot = MusicBot()
-    try:
-        logger.info("Starting Meep...")
-        bot.run(TOKEN)
-    except discord.LoginFailure:
-        logger.error("Invalid Discord token. Please check your .env file.")
-    except KeyboardInterrupt:
-        logger.info("Bot shutdown requested by user.")
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        logger.error("Please check your configuration and try again.")
\ No newline at end of file
+    if CLUSTER_WORKERS > 1:
+        try:
+            ClusterSupervisor().run()
+        except Exception as e:
+            logger.error(f"Cluster failed to start: {e}")
+            logger.error("Please check your configuration and try again.")
+    else:
+        bot = MusicBot()
+        try:
+            logger.info("Starting Meep...")
+            # Without log_handler=None discord.py adds its own synchronous console
+            # handler and forces its loggers to INFO, bypassing the queue and LOG_LEVEL
+            bot.run(TOKEN, log_handler=None)
+        except discord.LoginFailure:
+            logger.error("Invalid Discord token. Please check your .env file.")
+        except KeyboardInterrupt:
+            logger.info("Bot shutdown requested by user.")
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            logger.error("Please check your configuration and try again.")